@@ -0,0 +1,256 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import tempfile
+from pathlib import Path
+
+#Set global variables
+repo_dir = Path(__file__).resolve().parent.parent.parent
+output_lines = int(os.environ.get("KAP_BENCH_TF_LINES", "2000"))
+
+#Playbooks of the Service Node and the files of this repository they are read from
+playbooks = {
+     "k8s_deploy.yaml": repo_dir / "Ansible" / "k8s_deploy_v2.yaml",
+     "k8s_init.yaml": repo_dir / "Ansible" / "k8s_init.yaml"
+}
+
+#Function to print the progress lines that terraform writes while it creates a resource
+def print_progress(resource, lines):
+     print(f"{resource}: Creating...")
+
+     for i in range(lines):
+          print(f"{resource}: Still creating... [{(i + 1) * 10}s elapsed]")
+
+     print(f"{resource}: Creation complete after {(lines + 1) * 10}s [id={uuid.uuid4().hex[:17]}]")
+     print(f"Warning: {resource} uses a deprecated argument", file=sys.stderr)
+
+#Function to read the variables that a terraform command received
+def read_vars(tf_dir, args):
+     for arg in args:
+          if arg.startswith("-var-file="):
+               with open(arg.split("=", 1)[1]) as file:
+                    return json.load(file)
+
+          #A saved plan holds the variables it was created with
+          if arg.endswith(".tfplan") and not arg.startswith("-"):
+               with open(arg) as file:
+                    return json.load(file)
+
+     with open(f"{tf_dir}/dev.json") as file:
+          return json.load(file)
+
+#Function to write a terraform state with a new serial
+def write_state(tf_dir, outputs):
+     state_path = f"{tf_dir}/terraform.tfstate"
+     serial, lineage = 0, str(uuid.uuid4())
+
+     if os.path.exists(state_path):
+          with open(state_path) as file:
+               state = json.load(file)
+          serial, lineage = state["serial"], state["lineage"]
+
+     with open(state_path, "w") as file:
+          json.dump({"version": 4, "terraform_version": "1.9.0", "serial": serial + 1, "lineage": lineage,
+                     "outputs": {name: {"value": value, "type": "object"} for name, value in outputs.items()}, "resources": []}, file, indent=2)
+
+#Function to create the cluster instances, or the bucket, of a terraform module in the EC2 and S3 fakes
+def apply(tf_dir, tf_vars):
+     import boto3
+
+     if Path(tf_dir).name == "s3_deploy":
+          s3 = boto3.client("s3", region_name=tf_vars["region"])
+          print_progress("aws_s3_bucket.kap", output_lines // 10)
+          if tf_vars["bucket_name"] not in [bucket["Name"] for bucket in s3.list_buckets()["Buckets"]]:
+               s3.create_bucket(Bucket=tf_vars["bucket_name"], CreateBucketConfiguration={"LocationConstraint": tf_vars["region"]})
+          write_state(tf_dir, {})
+          return
+
+     ec2 = boto3.client("ec2", region_name=tf_vars["region"])
+     image = ec2.describe_images(Filters=[{"Name": "architecture", "Values": ["arm64"]}])["Images"][0]["ImageId"]
+
+     names = ["kservice", "NAT"] + [f"kmaster{i}" for i in range(tf_vars["num_masters"])] + [f"kworker{i}" for i in range(tf_vars["num_workers"])]
+     existing = {}
+     for reservation in ec2.describe_instances(Filters=[{"Name": "instance-state-name", "Values": ["running"]}])["Reservations"]:
+          for instance in reservation["Instances"]:
+               existing[{tag["Key"]: tag["Value"] for tag in instance["Tags"]}["Name"]] = instance
+
+     for name in names:
+          if name in existing:
+               continue
+
+          print_progress(f"aws_instance.{name}", output_lines // len(names))
+          existing[name] = ec2.run_instances(ImageId=image, InstanceType="t4g.small", MinCount=1, MaxCount=1,
+                                             TagSpecifications=[{"ResourceType": "instance", "Tags": [{"Key": "Name", "Value": name}]}])["Instances"][0]
+
+     write_state(tf_dir, {
+          "kmasters_info": {name: existing[name]["PrivateIpAddress"] for name in names if name.startswith("kmaster")},
+          "kworkers_info": {name: existing[name]["PrivateIpAddress"] for name in names if name.startswith("kworker")}
+     })
+     print(f"\nApply complete! Resources: {len(names)} added, 0 changed, 0 destroyed.")
+
+#Function to act as the terraform executable
+def terraform(argv):
+     tf_dir = argv[0].split("=", 1)[1]
+     act, args = argv[1], argv[2:]
+
+     if act == "init":
+          os.makedirs(f"{tf_dir}/.terraform", exist_ok=True)
+          print("Initializing the backend...\nInitializing provider plugins...\n- Installing hashicorp/aws v3.76.1...")
+          print("Terraform has been successfully initialized!")
+
+     elif act == "plan":
+          tf_vars = read_vars(tf_dir, args)
+          for i in range(output_lines // 2):
+               print(f"  # aws_security_group_rule.rule[{i}] will be created")
+
+          for arg in args:
+               if arg.startswith("-out="):
+                    with open(arg.split("=", 1)[1], "w") as file:
+                         json.dump(tf_vars, file)
+
+     elif act == "apply":
+          apply(tf_dir, read_vars(tf_dir, args))
+
+     elif act == "output":
+          with open(f"{tf_dir}/terraform.tfstate") as file:
+               print(json.dumps(json.load(file)["outputs"]))
+
+     elif act == "destroy":
+          import boto3
+          tf_vars = read_vars(tf_dir, args)
+          ec2 = boto3.client("ec2", region_name=tf_vars["region"])
+          ids = [instance["InstanceId"] for reservation in ec2.describe_instances()["Reservations"] for instance in reservation["Instances"]]
+          if len(ids) != 0:
+               ec2.terminate_instances(InstanceIds=ids)
+          print(f"\nDestroy complete! Resources: {len(ids)} destroyed.")
+
+#Function to resolve the hosts of an inventory group
+def group_hosts(inventory, group):
+     root = inventory["all"]
+     if group in root.get("hosts", {}) or group == "all":
+          return [group] if group != "all" else list(root.get("hosts", {}).keys())
+
+     def resolve(name):
+          node = root.get("children", {}).get(name, {})
+          hosts = list(node.get("hosts", {}).keys())
+          for child in node.get("children", {}).keys():
+               hosts += resolve(child)
+          return hosts
+
+     return resolve(group)
+
+#Function to act as the ansible-playbook executable, printing the plays and tasks of the real playbook for every host
+def ansible_playbook(argv):
+     playbook = argv[0]
+     inventory_path = argv[argv.index("-i") + 1] if "-i" in argv else "inventory.json"
+     limit = argv[argv.index("--limit") + 1].split(",") if "--limit" in argv else None
+
+     with open(inventory_path) as file:
+          inventory = json.load(file)
+
+     plays = []
+     for line in open(playbooks.get(playbook, repo_dir / "Ansible" / playbook)):
+          play = re.match(r"^- name: (.*)", line)
+          hosts = re.match(r"^  hosts: (\S+)", line)
+          task = re.match(r"^\s{4,}- name: (.*)", line)
+
+          if play != None:
+               plays.append({"name": play.group(1), "hosts": [], "tasks": ["Gathering Facts"]})
+          elif hosts != None:
+               plays[-1]["hosts"] = group_hosts(inventory, hosts.group(1))
+          elif task != None and len(plays) != 0:
+               plays[-1]["tasks"].append(task.group(1))
+
+     recap = {}
+     for play in plays:
+          hosts = [host for host in play["hosts"] if limit == None or host in limit]
+          print(f"\nPLAY [{play['name']}] {'*' * 40}")
+
+          if len(hosts) == 0:
+               print("skipping: no hosts matched")
+               continue
+
+          for i, task in enumerate(play["tasks"]):
+               print(f"\nTASK [{task}] {'*' * 40}")
+               for host in hosts:
+                    status = "changed" if i % 3 == 0 else "ok"
+                    print(f"{status}: [{host}]")
+                    recap.setdefault(host, {"ok": 0, "changed": 0})
+                    recap[host]["ok"] += 1
+                    recap[host]["changed"] += status == "changed"
+               sys.stdout.flush()
+
+     print(f"\nPLAY RECAP {'*' * 40}")
+     for host, counts in recap.items():
+          print(f"{host:27}: ok={counts['ok']:<4} changed={counts['changed']:<4} unreachable=0    failed=0    skipped=0    rescued=0    ignored=0")
+
+     #The deployment leaves the kubeconfig in the home and in the temporary directory of the Service Node
+     if playbook == "k8s_deploy.yaml":
+          for kube_dir in (os.path.expanduser("~/.kube"), f"{tempfile.gettempdir()}/kap"):
+               os.makedirs(kube_dir, exist_ok=True)
+               with open(f"{kube_dir}/{'config' if kube_dir.endswith('.kube') else 'kubeconfig'}", "w") as file:
+                    file.write("apiVersion: v1\nkind: Config\nclusters: []\n")
+
+#Function to read or write the Velero objects of a kind that the Service Node keeps
+def velero_state(kind, objects=None):
+     state_path = os.path.expanduser(f"~/.velero_{kind}.json")
+
+     if objects != None:
+          with open(state_path, "w") as file:
+               json.dump(objects, file)
+
+     elif os.path.exists(state_path):
+          with open(state_path) as file:
+               objects = json.load(file)
+
+     return objects or {}
+
+#Function to act as the velero executable, completing every backup and restore as soon as it is submitted
+def velero(argv):
+     kind = {"backup": "backups", "restore": "restores"}.get(argv[0])
+
+     if kind != None and argv[1] == "create":
+          objects = velero_state(kind)
+          name = argv[2]
+
+          if name in objects:
+               print(f'An error occurred: {kind}.velero.io "{name}" already exists', file=sys.stderr)
+               sys.exit(1)
+
+          labels = dict(label.split("=", 1) for label in argv[argv.index("--labels") + 1].split(",")) if "--labels" in argv else {}
+          namespaces = argv[argv.index("--include-namespaces") + 1].split(",") if "--include-namespaces" in argv else []
+          started = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+          time.sleep(0.01)
+
+          objects[name] = {"metadata": {"name": name, "namespace": "velero", "labels": labels}, "spec": {"includedNamespaces": namespaces},
+                           "status": {"phase": "Completed", "startTimestamp": started, "completionTimestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                                      "progress": {"itemsBackedUp": 20, "itemsRestored": 20, "totalItems": 20}}}
+          velero_state(kind, objects)
+
+          print(f'{argv[0].capitalize()} request "{name}" submitted successfully.')
+          print(f'Run `velero {argv[0]} describe {name}` or `velero {argv[0]} logs {name}` for more details.')
+
+#Function to act as the kubectl executable, listing the Velero objects that match a label, no pod volume backups and the pods, all of them ready
+def kubectl(argv):
+     if argv[0] == "get" and argv[1] in ("backups.velero.io", "restores.velero.io"):
+          selector = dict([argv[argv.index("-l") + 1].split("=", 1)]) if "-l" in argv else {}
+          name = argv[argv.index("--field-selector") + 1].split("=", 1)[1] if "--field-selector" in argv else None
+          items = [item for item in velero_state(argv[1].split(".")[0]).values()
+                   if selector.items() <= item["metadata"]["labels"].items() and name in (None, item["metadata"]["name"])]
+          print(json.dumps({"apiVersion": "v1", "kind": "List", "items": items}))
+
+     elif argv[:2] == ["get", "podvolumebackups.velero.io"]:
+          print(json.dumps({"apiVersion": "v1", "kind": "List", "items": []}))
+
+     elif argv[:2] == ["get", "pods"]:
+          namespaces = {namespace for restore in velero_state("restores").values() for namespace in restore["spec"]["includedNamespaces"]}
+          items = [{"metadata": {"name": f"app-{namespace}", "namespace": namespace}, "status": {"phase": "Running", "conditions": [{"type": "Ready", "status": "True"}]}}
+                   for namespace in sorted(namespaces)]
+          print(json.dumps({"apiVersion": "v1", "kind": "List", "items": items}))
+
+if __name__ == "__main__":
+     tools = {"terraform": terraform, "ansible-playbook": ansible_playbook, "velero": velero, "kubectl": kubectl}
+     tools[sys.argv[1]](sys.argv[2:])
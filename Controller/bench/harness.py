@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import argparse
+import subprocess
+import logging
+import urllib.request
+from statistics import median
+from pathlib import Path
+
+import paramiko
+from moto.server import ThreadedMotoServer
+
+import sshd
+
+#Set global variables
+bench_dir = Path(__file__).resolve().parent
+controller = str(bench_dir.parent / "kap_v2.py")
+region = "eu-west-3"
+
+#Function to obtain a free local port
+def free_port():
+     with socket.socket() as sock:
+          sock.bind(('127.0.0.1', 0))
+          return sock.getsockname()[1]
+
+#Function to create the executables that stand in for terraform, ansible-playbook, velero and kubectl
+def create_fake_bin(path):
+     os.makedirs(path)
+
+     for tool in ('terraform', 'ansible-playbook', 'velero', 'kubectl'):
+          with open(f"{path}/{tool}", "w") as file:
+               file.write(f'#!/bin/sh\nexec "{sys.executable}" "{bench_dir / "fakes.py"}" {tool} "$@"\n')
+          os.chmod(f"{path}/{tool}", 0o755)
+
+#Function to create a working directory with the configuration files that the controller expects, and the home directory of the Service Node
+def create_working_dir(path, masters, workers):
+     tf_dir = f"{path}/terraform"
+     os.makedirs(tf_dir + "/Infra_deploy")
+     os.makedirs(tf_dir + "/s3_deploy")
+     os.makedirs(f"{path}/.kube")
+     os.makedirs(f"{path}/service/kap")
+     os.makedirs(f"{path}/service/tmp")
+
+     paramiko.RSAKey.generate(2048).write_private_key_file(f"{path}/bench-key.pem")
+     with open(f"{path}/credentials-velero", "w") as file:
+          file.write("[default]\naws_access_key_id=testing\naws_secret_access_key=testing\n")
+
+     with open(f"{path}/config.json", "w") as file:
+          json.dump({"kube_dir": f"{path}/.kube", "tf_dir": tf_dir, "private_key_path": f"{path}/bench-key.pem",
+                     "s3_credentials_path": f"{path}/credentials-velero", "backup_namespaces": "default"}, file)
+
+     with open(f"{tf_dir}/Infra_deploy/dev.json", "w") as file:
+          json.dump({"region": region, "key_name": "bench-key", "master_instance_type": "t4g.small", "worker_instance_type": "t4g.small",
+                     "service_instance_type": "t4g.small", "num_masters": masters, "num_workers": workers}, file)
+
+     with open(f"{path}/k8s_dinamic_vars.json", "w") as file:
+          json.dump({"lb_address_pub": "", "kubernetes_version": "1.31", "region": region, "backup": True, "backup_name": "bench"}, file)
+
+#Function to run a controller mode, measuring its wall time, the CPU time of its process tree and the usage of each of its phases
+def run_controller(path, mode, env, extra_args):
+     trace_path = f"{path}/{mode}.trace.json"
+
+     with open(f"{path}/{mode}.log", "w") as log, tempfile.TemporaryFile("w+") as answers:
+          answers.write("no\n")
+          answers.seek(0)
+
+          start = time.perf_counter()
+          process = subprocess.Popen([sys.executable, controller, mode, "-trace", trace_path] + extra_args, cwd=path, env=env,
+                                     stdin=answers, stdout=log, stderr=subprocess.STDOUT)
+          pid, status, usage = os.wait4(process.pid, 0)
+          elapsed = time.perf_counter() - start
+          process.returncode = os.waitstatus_to_exitcode(status)
+
+     if process.returncode != 0:
+          with open(f"{path}/{mode}.log") as log:
+               raise Exception(f"Error: '{mode}' failed.\n{''.join(log.readlines()[-20:])}")
+
+     with open(trace_path) as file:
+          events = json.load(file)['traceEvents']
+
+     #The spans of a phase are added up, keeping the highest peak memory
+     phases = {}
+     for event in events:
+          phase = phases.setdefault(event['name'], {'calls': 0, 'wall_s': 0, 'cpu_s': 0, 'max_rss_kb': 0, 'syscr': 0, 'syscw': 0})
+          phase['calls'] += 1
+          phase['wall_s'] += event['dur'] / 1e6
+          phase['max_rss_kb'] = max(phase['max_rss_kb'], event['args'].get('max_rss_kb', 0))
+          for key in ('cpu_s', 'syscr', 'syscw'):
+               phase[key] += event['args'].get(key, 0)
+
+     return {'wall_s': elapsed, 'cpu_s': usage.ru_utime + usage.ru_stime, 'max_rss_kb': max(phase['max_rss_kb'] for phase in phases.values()), 'phases': phases}
+
+#Function to print the median of every measure across the runs of a mode
+def print_report(mode, results):
+     print(f"\n{mode}: wall {median(r['wall_s'] for r in results):.2f}s, CPU {median(r['cpu_s'] for r in results):.2f}s, "
+           f"peak RSS {max(r['max_rss_kb'] for r in results) / 1024:.1f}MB (CPU includes the terraform stand-in)")
+     print(f"{'wall':>9} {'CPU':>9} {'RSS':>8} {'syscr':>7} {'syscw':>7} {'calls':>5}  phase")
+
+     names = sorted(set().union(*[r['phases'].keys() for r in results]), key=lambda name: -median(r['phases'].get(name, {'wall_s': 0})['wall_s'] for r in results))
+     for name in names:
+          phases = [r['phases'][name] for r in results if name in r['phases']]
+          print(f"{median(p['wall_s'] for p in phases) * 1000:7.1f}ms {median(p['cpu_s'] for p in phases) * 1000:7.1f}ms "
+                f"{max(p['max_rss_kb'] for p in phases) / 1024:6.1f}MB {median(p['syscr'] for p in phases):7.0f} {median(p['syscw'] for p in phases):7.0f} "
+                f"{phases[0]['calls']:5d}  {name}")
+
+#Arguments declaration
+parse = argparse.ArgumentParser(description="End to end benchmark of the controller against local stand-ins of AWS, the Service Node and terraform.")
+parse.add_argument("-runs", type=int, default=3)
+parse.add_argument("-modes", default="create,join-cluster,save,restore")
+parse.add_argument("-n", default="3:2")
+parse.add_argument("-tf-lines", type=int, default=2000)
+parse.add_argument("-output", default=None)
+args = vars(parse.parse_args())
+
+masters, workers = (int(value) for value in args['n'].split(":"))
+modes = args['modes'].split(",")
+
+#Stand-ins of AWS and of the Service Node, shared by every run
+logging.getLogger("werkzeug").setLevel(logging.ERROR)
+moto_port = free_port()
+moto = ThreadedMotoServer(ip_address="127.0.0.1", port=moto_port, verbose=False)
+moto.start()
+ssh_port = sshd.serve()
+
+results = {mode: [] for mode in modes}
+
+try:
+     for run in range(args['runs']):
+          urllib.request.urlopen(urllib.request.Request(f"http://127.0.0.1:{moto_port}/moto-api/reset", method="POST")).close()
+
+          with tempfile.TemporaryDirectory() as path:
+               create_working_dir(path, masters, workers)
+               create_fake_bin(f"{path}/bin")
+
+               env = dict(os.environ, AWS_ENDPOINT_URL=f"http://127.0.0.1:{moto_port}", AWS_ACCESS_KEY_ID="testing", AWS_SECRET_ACCESS_KEY="testing",
+                          AWS_DEFAULT_REGION=region, KAP_BENCH_SSH_PORT=str(ssh_port), KAP_BENCH_TF_LINES=str(args['tf_lines']),
+                          PYTHONPATH=str(bench_dir / "site"), PATH=f"{path}/bin:{os.environ['PATH']}")
+               sshd.server.update({'root': f"{path}/service", 'path': env['PATH']})
+
+               for mode in modes:
+                    extra_args = ["-n", args['n'], "-backup", "bench"] if mode == "create" else []
+                    results[mode].append(run_controller(path, mode, env, extra_args))
+
+               print(f"Run {run + 1}/{args['runs']}: " + ", ".join(f"{mode} {results[mode][-1]['wall_s']:.2f}s" for mode in modes))
+
+finally:
+     moto.stop()
+
+for mode in modes:
+     print_report(mode, results[mode])
+
+if args['output'] != None:
+     with open(args['output'], "w") as file:
+          json.dump(results, file, indent=4)
@@ -0,0 +1,14 @@
+import os
+import socket
+
+#The benchmark points the SSH connections of the controller to its local stand-in of the Service Node
+if os.environ.get("KAP_BENCH_SSH_PORT"):
+     system_getaddrinfo = socket.getaddrinfo
+
+     def getaddrinfo(host, port, *args, **kwargs):
+          if port == 22:
+               return system_getaddrinfo("127.0.0.1", int(os.environ["KAP_BENCH_SSH_PORT"]), *args, **kwargs)
+
+          return system_getaddrinfo(host, port, *args, **kwargs)
+
+     socket.getaddrinfo = getaddrinfo
@@ -0,0 +1,138 @@
+import os
+import re
+import socket
+import threading
+import subprocess
+import paramiko
+from paramiko import SFTPServer, SFTPServerInterface, SFTPAttributes, SFTPHandle, SFTP_OK
+
+#Set global variables
+host_key = paramiko.RSAKey.generate(2048)
+remote_paths = re.compile(r"(?<![\w.-])(/home/ubuntu|/tmp)(?=/|\b|$)")
+
+#Directory that stands in for the Service Node and the executables its commands can reach
+server = {'root': None, 'path': os.environ.get("PATH", "")}
+
+#Function to map the home and temporary paths of the Service Node to the local directory that stands in for it
+def local_path(path):
+     return remote_paths.sub(lambda match: server['root'] + ("/tmp" if match.group(1) == "/tmp" else ""), path)
+
+#Handle of a file opened through SFTP
+class FileHandle(SFTPHandle):
+     def stat(self):
+          file = getattr(self, 'readfile', None) or getattr(self, 'writefile')
+          return SFTPAttributes.from_stat(os.fstat(file.fileno()))
+
+#SFTP subsystem over the stand-in home directory
+class SFTPInterface(SFTPServerInterface):
+     def open(self, path, flags, attr):
+          fd = os.open(local_path(path), flags, 0o644)
+          handle = FileHandle(flags)
+
+          if flags & (os.O_WRONLY | os.O_RDWR) == 0:
+               handle.readfile = os.fdopen(fd, 'rb')
+          else:
+               handle.writefile = os.fdopen(fd, 'wb')
+
+          return handle
+
+     def stat(self, path):
+          return SFTPAttributes.from_stat(os.stat(local_path(path)))
+
+     def lstat(self, path):
+          return SFTPAttributes.from_stat(os.lstat(local_path(path)))
+
+     def chattr(self, path, attr):
+          os.chmod(local_path(path), attr.st_mode)
+          return SFTP_OK
+
+     def posix_rename(self, oldpath, newpath):
+          os.replace(local_path(oldpath), local_path(newpath))
+          return SFTP_OK
+
+     def rename(self, oldpath, newpath):
+          return self.posix_rename(oldpath, newpath)
+
+     def remove(self, path):
+          os.remove(local_path(path))
+          return SFTP_OK
+
+     def mkdir(self, path, attr):
+          os.mkdir(local_path(path))
+          return SFTP_OK
+
+     def list_folder(self, path):
+          return [SFTPAttributes.from_stat(os.stat(os.path.join(local_path(path), name)), name) for name in os.listdir(local_path(path))]
+
+#SSH server that accepts any key and runs the commands in the stand-in home directory, streaming their output
+class ServiceNode(paramiko.ServerInterface):
+     def __init__(self):
+          self.pty_channels = set()
+
+     def get_allowed_auths(self, username):
+          return 'publickey'
+
+     def check_auth_publickey(self, username, key):
+          return paramiko.AUTH_SUCCESSFUL
+
+     def check_channel_request(self, kind, chanid):
+          return paramiko.OPEN_SUCCEEDED
+
+     def check_channel_pty_request(self, channel, *args):
+          self.pty_channels.add(channel.get_id())
+          return True
+
+     def check_channel_exec_request(self, channel, command):
+          threading.Thread(target=self.run, args=(channel, command.decode()), daemon=True).start()
+          return True
+
+     def run(self, channel, command):
+          pty = channel.get_id() in self.pty_channels
+          env = dict(os.environ, HOME=server['root'], TMPDIR=server['root'] + "/tmp", PATH=server['path'])
+          process = subprocess.Popen(['bash', '-c', local_path(command)], cwd=server['root'], env=env,
+                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT if pty else subprocess.PIPE)
+
+          #A terminal merges both streams, otherwise stderr is forwarded from its own thread
+          if not pty:
+               forward = threading.Thread(target=self.forward, args=(process.stderr, channel.sendall_stderr))
+               forward.start()
+
+          self.forward(process.stdout, channel.sendall)
+
+          if not pty:
+               forward.join()
+
+          try:
+               channel.send_exit_status(process.wait())
+               channel.close()
+
+          except OSError:
+               pass
+
+     #The client may close the channel before the command ends, the rest of its output is then discarded
+     def forward(self, stream, send):
+          for chunk in iter(lambda: stream.read1(65536), b""):
+               try:
+                    send(chunk)
+
+               except OSError:
+                    pass
+
+#Function to start the SSH server on a free local port, serving every connection from its own transport
+def serve():
+     sock = socket.socket()
+     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+     sock.bind(('127.0.0.1', 0))
+     sock.listen(50)
+
+     def accept():
+          while True:
+               client, address = sock.accept()
+               transport = paramiko.Transport(client)
+               transport.add_server_key(host_key)
+               transport.set_subsystem_handler('sftp', SFTPServer, SFTPInterface)
+               transport.start_server(server=ServiceNode())
+
+     threading.Thread(target=accept, daemon=True).start()
+
+     return sock.getsockname()[1]
@@ -0,0 +1,72 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import subprocess
+from statistics import median
+from pathlib import Path
+
+#Set global variables
+controller = str(Path(__file__).resolve().parent.parent / "kap_v2.py")
+heavy_modules = ('boto3', 'botocore', 'paramiko', 'asyncio')
+
+#Function to create a working directory with the configuration files that the controller expects
+def create_working_dir(path):
+     tf_dir = f"{path}/terraform"
+     os.makedirs(tf_dir + "/Infra_deploy")
+     os.makedirs(tf_dir + "/s3_deploy")
+
+     with open(f"{path}/config.json", "w") as file:
+          json.dump({"kube_dir": f"{path}/.kube", "tf_dir": tf_dir, "private_key_path": f"{path}/test01-key.pem", "s3_credentials_path": "", "backup_namespaces": "default"}, file)
+
+     with open(f"{tf_dir}/Infra_deploy/dev.json", "w") as file:
+          json.dump({"region": "eu-west-3", "key_name": "test01-key", "master_instance_type": "t4g.small", "worker_instance_type": "t4g.small", "service_instance_type": "t4g.small", "num_masters": 3, "num_workers": 2}, file)
+
+     with open(f"{path}/k8s_dinamic_vars.json", "w") as file:
+          json.dump({"lb_address_pub": "", "kubernetes_version": "1.31", "region": "eu-west-3", "backup": False, "backup_name": "test01"}, file)
+
+#Function to time a controller invocation and list the heavy modules it imported
+def run_controller(path, mode):
+     start = time.perf_counter()
+     process = subprocess.run([sys.executable, "-X", "importtime", controller, mode], cwd=path, capture_output=True, text=True)
+     elapsed = time.perf_counter() - start
+
+     if process.returncode != 0:
+          raise Exception(f"Error: '{mode}' failed.\n{process.stderr}")
+
+     imported = set()
+     for line in process.stderr.splitlines():
+          module = line.split("|")[-1].strip()
+          if module.split(".")[0] in heavy_modules:
+               imported.add(module.split(".")[0])
+
+     return elapsed, imported
+
+#Arguments declaration
+parse = argparse.ArgumentParser(description="Startup time benchmark of the local-only controller modes.")
+parse.add_argument("-runs", type=int, default=20)
+parse.add_argument("-budget-ms", type=float, default=100)
+args = vars(parse.parse_args())
+
+failed = False
+with tempfile.TemporaryDirectory() as path:
+     create_working_dir(path)
+
+     for mode in ('--help', 'list-args'):
+          results = [run_controller(path, mode) for i in range(args['runs'])]
+          times = [elapsed * 1000 for elapsed, imported in results]
+          imported = set().union(*[imported for elapsed, imported in results])
+
+          print(f"{mode}: median {median(times):.1f}ms, min {min(times):.1f}ms, max {max(times):.1f}ms")
+
+          if len(imported) != 0:
+               print(f"  Regression: {mode} imports {', '.join(sorted(imported))}")
+               failed = True
+
+          if median(times) > args['budget_ms']:
+               print(f"  Regression: {mode} exceeds the {args['budget_ms']:.0f}ms budget")
+               failed = True
+
+sys.exit(1 if failed else 0)
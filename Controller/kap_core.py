@@ -0,0 +1,2256 @@
+import os
+import json
+import time
+import argparse
+import threading
+import copy
+import sys
+import re
+import shlex
+import atexit
+import functools
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+#Obtain working directory
+working_dir = os.getcwd().replace("\\","/")
+
+#Set global variables
+ssh_username = 'ubuntu'
+ec2_name = 'kservice'
+ssh_keepalive = 30
+
+#Shared boto3 session and its cached clients per service and region
+aws_session = None
+aws_clients = {}
+aws_lock = threading.Lock()
+
+#Cached S3 bucket existence checks and their time to live
+s3_buckets = {}
+s3_cache_ttl = 60
+
+#Size of the ranged downloads and multipart uploads of the backup exports
+transfer_chunk = 8 * 2**20
+
+#Pooled SSH connections and their SFTP channels
+ssh_sessions = {}
+ssh_params = {}
+sftp_sessions = {}
+
+#Configuration files loaded in this run, with their contents as they were read
+config_files = {}
+
+#Attempts and seconds spent waiting for each resource
+wait_metrics = {}
+
+#Local cache of the Helm and Velero releases installed on the Service Node
+artifact_cache_dir = working_dir + "/.kap_cache"
+
+#Phases completed by the last create, kept while its input configuration does not change
+checkpoint_path = working_dir + "/.kap_create.json"
+checkpoints = {'config': None, 'phases': {}}
+
+#Inputs of every Terraform module at its last apply, and the resources that each of its variables configures
+tf_inputs_path = working_dir + "/.tf_inputs.json"
+tf_var_targets = {
+     "Infra_deploy": {
+          "key_name": ["aws_instance.kservice", "aws_instance.kmasters", "aws_instance.kworkers"],
+          "master_instance_type": ["aws_instance.kmasters"],
+          "worker_instance_type": ["aws_instance.kworkers"],
+          "service_instance_type": ["aws_instance.kservice"],
+          "num_masters": ["aws_instance.kmasters"],
+          "num_workers": ["aws_instance.kworkers"],
+          "node_ami": []
+     },
+     "s3_deploy": {
+          "bucket_name": ["aws_s3_bucket.k8s_storage"]
+     }
+}
+
+#Spans recorded in this run and the span that is currently open in each thread or asyncio task
+trace_spans = []
+trace_parent = contextvars.ContextVar('trace_parent', default=None)
+trace_start = time.time()
+
+#Resource usage is only sampled for each span when a trace has been requested
+trace_usage = False
+
+#Function to sample the CPU time, peak memory and I/O syscalls of the process, where the platform reports them through /proc
+def resource_usage():
+     usage = {'cpu_s': time.process_time()}
+
+     for file_path, keys in (("/proc/self/status", ('VmHWM',)), ("/proc/self/io", ('syscr', 'syscw'))):
+          try:
+               with open(file_path) as file:
+                    for line in file:
+                         key, value = line.split(":", 1)
+                         if key in keys:
+                              usage['max_rss_kb' if key == 'VmHWM' else key] = int(value.split()[0])
+
+          except OSError:
+               pass
+
+     return usage
+
+#Function to time a phase of the run as a span of the trace
+@contextmanager
+def span(name, **attributes):
+     import random
+
+     record = {'id': random.getrandbits(64), 'parent': trace_parent.get(), 'name': name, 'start': time.time(), 'duration': 0,
+               'thread': threading.get_ident(), 'attributes': attributes}
+     token = trace_parent.set(record['id'])
+     usage = resource_usage() if trace_usage else None
+     start = time.perf_counter()
+
+     try:
+          yield record
+
+     finally:
+          record['duration'] = time.perf_counter() - start
+          trace_parent.reset(token)
+
+          #Usage is process-wide, so it includes every thread that ran during the span. Peak memory is kept as is
+          if usage != None:
+               for key, value in resource_usage().items():
+                    record['attributes'][key] = value if key == 'max_rss_kb' else round(value - usage[key], 6)
+
+          trace_spans.append(record)
+
+#Function to record every call of a function as a span of the trace
+def traced(name):
+     def decorator(function):
+          @functools.wraps(function)
+          def wrapper(*fargs, **fkwargs):
+               with span(name):
+                    return function(*fargs, **fkwargs)
+
+          return wrapper
+
+     return decorator
+
+#Function to export the recorded spans as a Chrome trace or as OTLP-JSON
+def export_trace(file_path, trace_format):
+     import random
+
+     if trace_format == 'chrome':
+          trace = {'displayTimeUnit': 'ms', 'traceEvents': [
+               {'name': record['name'], 'ph': 'X', 'ts': int(record['start'] * 1e6), 'dur': int(record['duration'] * 1e6),
+                'pid': os.getpid(), 'tid': record['thread'], 'args': record['attributes']}
+               for record in trace_spans
+          ]}
+
+     else:
+          trace_id = f"{random.getrandbits(128):032x}"
+          trace = {'resourceSpans': [{
+               'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'kap'}}]},
+               'scopeSpans': [{'scope': {'name': 'kap'}, 'spans': [
+                    {'traceId': trace_id, 'spanId': f"{record['id']:016x}", 'parentSpanId': f"{record['parent']:016x}" if record['parent'] != None else "",
+                     'name': record['name'], 'kind': 1,
+                     'startTimeUnixNano': str(int(record['start'] * 1e9)), 'endTimeUnixNano': str(int((record['start'] + record['duration']) * 1e9)),
+                     'attributes': [{'key': key, 'value': {'stringValue': str(value)}} for key, value in record['attributes'].items()]}
+                    for record in trace_spans
+               ]}]
+          }]}
+
+     with open(file_path, 'w') as file:
+          json.dump(trace, file)
+
+     print(f"Trace written to {file_path}")
+
+#Function to print the time spent in each phase of the run
+def print_trace_summary():
+     total = time.time() - trace_start
+     phases = {}
+
+     for record in trace_spans:
+          phases.setdefault(record['name'], {'calls': 0, 'time': 0, 'cpu': 0})
+          phases[record['name']]['calls'] += 1
+          phases[record['name']]['time'] += record['duration']
+          phases[record['name']]['cpu'] += record['attributes'].get('cpu_s', 0)
+
+     print(f"\nPhase breakdown ({total:.1f}s in total):")
+     for name, phase in sorted(phases.items(), key=lambda item: item[1]['time'], reverse=True):
+          print(f"{phase['time']:8.1f}s {100 * phase['time'] / total:5.1f}% {phase['calls']:4d}x {phase['cpu']:7.2f}s CPU  {name}")
+
+#Function to reuse the boto3 client of a service and region, creating it on first use
+def aws_client(service, aws_region):
+     global aws_session
+     from boto3 import Session
+     from botocore.config import Config
+
+     with aws_lock:
+          if (service, aws_region) not in aws_clients:
+               if aws_session == None:
+                    aws_session = Session()
+
+               aws_clients[(service, aws_region)] = aws_session.client(service, region_name=aws_region, config=Config(
+                    max_pool_connections=scriptargs.get("aws_max_pool_connections", 10),
+                    retries={'mode': 'adaptive', 'max_attempts': scriptargs.get("aws_max_attempts", 10)}
+               ))
+
+     return aws_clients[(service, aws_region)]
+
+#Function to obtain data from every running cluster node in a single paginated call
+def get_cluster_nodes(aws_region, names=(ec2_name, 'kmaster*', 'kworker*')):
+     paginator = aws_client('ec2', aws_region).get_paginator('describe_instances')
+     nodes = {}
+
+     for page in paginator.paginate(
+          Filters=[
+               {'Name': 'instance-state-name', 'Values': ['running']},
+               {'Name': 'tag:Name', 'Values': list(names)}
+          ]
+     ):
+          for reservation in page['Reservations']:
+               for instance in reservation['Instances']:
+                    for tag in instance.get('Tags', []):
+                         if tag['Key'] == 'Name':
+                              nodes[tag['Value']] = instance
+
+     return nodes
+
+#Function to obtain data from an EC2 instance
+def get_ec2_info(ec2_name, aws_region):
+     nodes = get_cluster_nodes(aws_region, (ec2_name,))
+
+     if ec2_name not in nodes:
+          raise Exception("Something went wrong. No resources where found.")
+
+     return nodes[ec2_name]
+
+#Function to obtain the private address of every Kubernetes node that already passes its status checks
+def ready_nodes(aws_region):
+     nodes = get_cluster_nodes(aws_region, ('kmaster*', 'kworker*'))
+     names = {instance['InstanceId']: name for name, instance in nodes.items()}
+
+     if len(names) == 0:
+          return {}
+
+     statuses = aws_client('ec2', aws_region).describe_instance_status(InstanceIds=list(names.keys()))['InstanceStatuses']
+
+     return {names[status['InstanceId']]: nodes[names[status['InstanceId']]]['PrivateIpAddress'] for status in statuses
+             if status['InstanceStatus']['Status'] == 'ok' and status['SystemStatus']['Status'] == 'ok'}
+
+#Function to wait until EC2 instances are running, and optionally passing their status checks, through the EC2 waiters
+@traced("wait_ec2_instances")
+def wait_ec2_instances(names, aws_region, deadline, status_ok=False):
+     from botocore.exceptions import WaiterError
+
+     waiter_config = {'Delay': 2, 'MaxAttempts': max(1, deadline // 2)}
+
+     try:
+          aws_client('ec2', aws_region).get_waiter('instance_running').wait(
+               Filters=[
+                    {'Name': 'instance-state-name', 'Values': ['pending', 'running']},
+                    {'Name': 'tag:Name', 'Values': list(names)}
+               ],
+               WaiterConfig=waiter_config
+          )
+
+          nodes = get_cluster_nodes(aws_region, names)
+
+          if status_ok and len(nodes) > 0:
+               waiter_config = {'Delay': 10, 'MaxAttempts': max(1, deadline // 10)}
+               aws_client('ec2', aws_region).get_waiter('instance_status_ok').wait(
+                    InstanceIds=[instance['InstanceId'] for instance in nodes.values()],
+                    WaiterConfig=waiter_config
+               )
+
+     except WaiterError as e:
+          raise Exception(f"Error: Unable to reach {', '.join(names)}. Time exceeded. {e}")
+
+     return nodes
+
+#Function to check status of an S3 bucket
+@traced("check_s3_bucket")
+def check_s3_bucket(s3_name, aws_region):
+     from botocore.exceptions import ClientError
+
+     #Only found buckets are cached so that a missing bucket keeps being probed
+     if s3_name in s3_buckets and time.monotonic() - s3_buckets[s3_name] < s3_cache_ttl:
+          return True
+
+     try:
+          s3_bucket = aws_client('s3', aws_region).head_bucket(Bucket=s3_name)
+     
+     except ClientError as e:
+          if e.response['Error']['Code'] in ('404', 'NoSuchBucket'):
+               return False
+          
+          raise
+
+     bucket_region = s3_bucket.get('BucketRegion', s3_bucket['ResponseMetadata']['HTTPHeaders'].get('x-amz-bucket-region', aws_region))
+     if bucket_region != aws_region:
+          print(f"Warning: bucket {s3_name} is located in {bucket_region}, not in {aws_region}.")
+
+     s3_buckets[s3_name] = time.monotonic()
+
+     return True
+
+#Function to obtain the number of bytes stored under a prefix of an S3 bucket
+def s3_prefix_size(s3_name, aws_region, prefix):
+     paginator = aws_client('s3', aws_region).get_paginator('list_objects_v2')
+
+     return sum(item['Size'] for page in paginator.paginate(Bucket=s3_name, Prefix=prefix) for item in page.get('Contents', []))
+
+#Function to establish an SSH connection with a host
+@traced("ssh_connect")
+def ssh_connect(dns_name, username, private_key_path):
+    import paramiko
+
+    ssh = paramiko.SSHClient()
+    ssh.load_system_host_keys()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(dns_name, username=username, key_filename=private_key_path)
+    ssh.get_transport().set_keepalive(ssh_keepalive)
+
+    ssh_params[ssh] = (dns_name, username, private_key_path)
+
+    return ssh
+
+#Function to check that the transport of an SSH connection is still alive
+def ssh_alive(ssh_obj):
+     transport = ssh_obj.get_transport()
+
+     if transport == None or not transport.is_active():
+          return False
+
+     try:
+          transport.send_ignore()
+
+     except Exception:
+          return False
+
+     return True
+
+#Function to reuse the pooled SSH connection with a host, establishing it if needed
+def ssh_session(dns_name, username, private_key_path):
+     key = (dns_name, username)
+
+     if key in ssh_sessions:
+          return ssh_reconnect(ssh_sessions[key])
+
+     ssh_sessions[key] = ssh_connect(dns_name, username, private_key_path)
+
+     return ssh_sessions[key]
+
+#Function to reconnect an SSH connection whose transport has been lost
+def ssh_reconnect(ssh_obj):
+     if ssh_alive(ssh_obj):
+          return ssh_obj
+
+     dns_name, username, private_key_path = ssh_params[ssh_obj]
+     print(f"Reconnecting with host {dns_name}...")
+
+     sftp_sessions.pop(ssh_obj, None)
+     ssh_obj.close()
+     ssh_obj.connect(dns_name, username=username, key_filename=private_key_path)
+     ssh_obj.get_transport().set_keepalive(ssh_keepalive)
+
+     return ssh_obj
+
+#Function to close every pooled SSH connection
+def ssh_close_all():
+     for ssh in ssh_sessions.values():
+          ssh.close()
+
+     ssh_sessions.clear()
+     sftp_sessions.clear()
+
+#Function to execute a CLI command on a host through SSH, with its output streams in binary mode
+def ssh_exec(ssh_obj, cmd, pty=False):
+    channel = ssh_reconnect(ssh_obj).get_transport().open_session()
+    if pty:
+        channel.get_pty()
+    channel.exec_command(cmd)
+
+    return({'stdin':channel.makefile_stdin('wb'), 'stdout':channel.makefile('rb'), 'stderr':channel.makefile_stderr('rb')})
+
+#Function to read a stream line by line, queuing every line with its arrival time
+def stream_reader(stream, name, lines):
+     try:
+          #Invalid bytes are replaced so that a decoding error never stops the draining of the pipe
+          for line in stream:
+               if isinstance(line, bytes):
+                    line = line.decode('utf-8', errors='replace')
+               lines.put((time.time(), name, line.rstrip()))
+
+     finally:
+          lines.put((time.time(), name, None))
+
+#Function to perform a concurrent read of the stdout and stderr of a command
+def stream_read(std, tail=200, prefix=None, on_line=None):
+     import queue
+
+     #Only the last lines of each stream are kept in memory
+     output = {'stdout': deque(maxlen=tail), 'stderr': deque(maxlen=tail)}
+     lines = queue.Queue(maxsize=1000)
+
+     for name in output.keys():
+          threading.Thread(target=stream_reader, args=(std[name], name, lines), daemon=True).start()
+
+     open_streams = len(output)
+     while open_streams > 0:
+          timestamp, name, line = lines.get()
+
+          if line is None:
+               open_streams -= 1
+               continue
+
+          output[name].append(line)
+
+          #Lines can be handed to a parser instead of being printed
+          if on_line != None:
+               on_line(timestamp, name, line)
+               continue
+
+          if prefix != None:
+               line = f"{prefix}: {line}"
+
+          print(f"[{time.strftime('%H:%M:%S', time.localtime(timestamp))}] {line}")
+
+     return output
+
+#Function to reuse the SFTP channel of an SSH connection, opening it if needed
+def sftp_session(ssh_obj):
+     ssh_obj = ssh_reconnect(ssh_obj)
+
+     if ssh_obj not in sftp_sessions:
+          sftp_sessions[ssh_obj] = ssh_obj.open_sftp()
+
+     return sftp_sessions[ssh_obj]
+
+#Function to calculate the SHA-256 hash of a local file
+def file_sha256(file_path):
+     import hashlib
+
+     digest = hashlib.sha256()
+
+     with open(file_path, 'rb') as file:
+          for chunk in iter(lambda: file.read(1024 * 1024), b''):
+               digest.update(chunk)
+
+     return digest.hexdigest()
+
+#Function to obtain the Helm and Velero releases that the Service Node installs, rendered from its k8s_vars.yaml for its architecture
+def service_binaries(ssh_obj):
+     std = ssh_exec(ssh_obj, "cd /home/ubuntu/kap/ && ansible localhost -i localhost, -c local -m debug -a var=binaries -e @k8s_vars.yaml -e binaries_arch=$(dpkg --print-architecture)")
+     output = std['stdout'].read().decode()
+
+     if std['stdout'].channel.recv_exit_status() != 0 or "=>" not in output:
+          raise Exception(f"Error: unable to read the binaries of k8s_vars.yaml on the Service Node: {std['stderr'].read().decode().strip()}")
+
+     return json.loads(output.split("=>", 1)[1])['binaries']
+
+#Function to obtain an artifact from the content-addressed cache, downloading and verifying it against its published checksum when missing
+def cache_artifact(artifact):
+     import urllib.request
+     import tempfile
+     import shutil
+
+     index = read_json(artifact_cache_dir + "/index.json", missing_ok=True)
+     digest = index.get(artifact["tar_url"])
+
+     if digest != None and os.path.exists(f"{artifact_cache_dir}/sha256/{digest}"):
+          return digest, f"{artifact_cache_dir}/sha256/{digest}"
+
+     file_name = artifact["tar_url"].rsplit("/", 1)[1]
+     with urllib.request.urlopen(artifact["checksum_url"], timeout=30) as response:
+          checksums = response.read().decode().splitlines()
+
+     #Checksum files either hold a single hash or one "hash  file" line per release file
+     digest = None
+     for line in checksums:
+          fields = line.split()
+          if len(fields) == 1 or (len(fields) == 2 and fields[1].lstrip("*") == file_name):
+               digest = fields[0].lower()
+               break
+
+     if digest == None:
+          raise Exception(f"Error: no checksum was published for {file_name}")
+
+     os.makedirs(artifact_cache_dir + "/sha256", exist_ok=True)
+     print(f"Downloading {file_name}...")
+
+     with urllib.request.urlopen(artifact["tar_url"], timeout=60) as response, tempfile.NamedTemporaryFile('wb', dir=artifact_cache_dir, suffix=".tmp", delete=False) as file:
+          shutil.copyfileobj(response, file)
+
+     if file_sha256(file.name) != digest:
+          os.remove(file.name)
+          raise Exception(f"Error: checksum mismatch for {file_name}")
+
+     os.replace(file.name, f"{artifact_cache_dir}/sha256/{digest}")
+     index[artifact["tar_url"]] = digest
+     write_json(artifact_cache_dir + "/index.json", index)
+
+     return digest, f"{artifact_cache_dir}/sha256/{digest}"
+
+#Function to synchronize a manifest of (local path, remote path, mode) entries with a host, uploading only the files that changed
+@traced("sync_files")
+def sync_files(ssh_obj, manifest):
+
+     #Sizes and hashes of every remote file are obtained in a single round trip
+     remote_paths = " ".join(shlex.quote(dest_path) for src_path, dest_path, mode in manifest)
+     std = ssh_exec(ssh_obj, f'for f in {remote_paths}; do [ -f "$f" ] && echo "$(stat -c %s "$f") $(sha256sum < "$f" | cut -d " " -f 1) $f"; done')
+
+     remote_files = {}
+     for line in std['stdout']:
+          size, digest, dest_path = line.decode().strip().split(" ", 2)
+          remote_files[dest_path] = (int(size), digest)
+
+     sftp = sftp_session(ssh_obj)
+     uploaded = []
+
+     for src_path, dest_path, mode in manifest:
+          if dest_path in remote_files and remote_files[dest_path][0] == os.path.getsize(src_path) and remote_files[dest_path][1] == file_sha256(src_path):
+               continue
+
+          #The file is replaced through a rename so that read-only files can be updated
+          sftp.put(src_path, dest_path + ".kaptmp")
+          sftp.chmod(dest_path + ".kaptmp", mode)
+          sftp.posix_rename(dest_path + ".kaptmp", dest_path)
+          uploaded.append(Path(dest_path).name)
+
+     if len(uploaded) != 0:
+          print(f"Uploaded {', '.join(uploaded)}")
+
+     return uploaded
+
+#Function to restrieve a remote file from a host to a local directory through SFTP
+@traced("sftp_get_file")
+def sftp_get_file(ssh_obj, src_path, dest_path):
+     if os.path.isdir(dest_path):
+          dest_path = f"{dest_path}/{Path(src_path).name}"
+
+     sftp_session(ssh_obj).get(src_path, dest_path)
+
+#Function to wait until a probe succeeds, retrying with jittered exponential backoff until a deadline
+def wait_until(name, probe, deadline, fatal=None, retry_msg=None, base_delay=1, max_delay=10):
+     import random
+
+     with span(f"wait {name}"):
+          start = time.monotonic()
+          attempt = 0
+
+          while True:
+               attempt += 1
+               error = None
+
+               try:
+                    result = probe()
+
+               except Exception as e:
+                    if fatal != None and fatal(e):
+                         wait_metrics[name] = {'attempts': attempt, 'waited': time.monotonic() - start}
+                         raise
+
+                    result = None
+                    error = e
+
+               if result:
+                    wait_metrics[name] = {'attempts': attempt, 'waited': time.monotonic() - start}
+                    return result
+
+               elapsed = time.monotonic() - start
+               if elapsed >= deadline:
+                    wait_metrics[name] = {'attempts': attempt, 'waited': elapsed}
+                    raise Exception(f"Error: Unable to reach {name}. Time exceeded after {attempt} attempts. {error if error != None else ''}")
+
+               if retry_msg != None:
+                    print(retry_msg)
+
+               delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+               time.sleep(min(random.uniform(delay / 2, delay), deadline - elapsed))
+
+#Function to print the time spent waiting for each resource
+def print_wait_metrics():
+     if len(wait_metrics) == 0:
+          return
+
+     print("\nTime spent waiting:")
+     for name, metrics in wait_metrics.items():
+          print(f"{name}: {metrics['waited']:.1f}s ({metrics['attempts']} attempts)")
+
+#Function to classify the AWS errors that retrying will not solve
+def aws_error_fatal(e):
+     from botocore.exceptions import ClientError, NoCredentialsError
+
+     if isinstance(e, NoCredentialsError):
+          return True
+
+     if isinstance(e, ClientError):
+          return e.response['Error']['Code'] in ('AuthFailure', 'UnauthorizedOperation', 'InvalidClientTokenId', 'AccessDenied', '403', 'ExpiredToken', 'SignatureDoesNotMatch')
+
+     return False
+
+#Function to classify the SSH errors that retrying will not solve
+def ssh_error_fatal(e):
+     import paramiko
+
+     return isinstance(e, (paramiko.BadHostKeyException, paramiko.PasswordRequiredException, FileNotFoundError, PermissionError))
+
+#Function to tun a terraform command
+def run_terraform_cmd(act, tf_dir, *args):
+     import subprocess
+
+     cmd = ['terraform', f"-chdir={tf_dir}", act]
+
+     if act not in ('init', 'plan', 'apply', 'destroy'):
+          raise ValueError("Invalid argument.")
+     
+     if len(args) != 0:
+          cmd = cmd + list(args)
+
+     process = subprocess.Popen(
+     cmd,
+     stdout=subprocess.PIPE,
+     stdin=subprocess.PIPE,
+     stderr=subprocess.PIPE,
+     text=True,
+     encoding='utf-8',
+     errors='replace'
+     ) 
+
+     return({'stdin':process.stdin, 'stdout':process.stdout, 'stderr':process.stderr, 'process':process})
+
+#Function to run a terraform command asynchronously and wait for its exit code
+async def run_terraform_async(act, tf_dir, *args):
+     import asyncio
+
+     with span(f"terraform {act}", module=Path(tf_dir).name):
+          std = run_terraform_cmd(act, tf_dir, *args)
+
+          output = await asyncio.to_thread(stream_read, std, prefix=Path(tf_dir).name)
+          returncode = await asyncio.to_thread(std['process'].wait)
+
+     if returncode != 0:
+          raise Exception(f"Error: terraform {act} failed in {tf_dir} with exit code {returncode}.")
+
+     return {'returncode': returncode, 'stdout': output['stdout'], 'stderr': output['stderr']}
+
+#Function to initialize, plan and optionally apply a Terraform working directory
+async def run_terraform_module(tf_dir, apply, *plan_args):
+
+     #Initiation of the Terraform working directory is not initiated yet
+     if not (os.path.isdir(tf_dir + '/.terraform')):
+          print(f"Initializing Terraform environment in {Path(tf_dir).name}...")
+          await run_terraform_async('init', tf_dir, '-input=false')
+
+     await run_terraform_async('plan', tf_dir, f'-out={tf_dir}/k8s-plan.tfplan', '-input=false', *plan_args)
+
+     if apply:
+          await run_terraform_async('apply', tf_dir, f'{tf_dir}/k8s-plan.tfplan')
+          record_tf_inputs(tf_dir)
+
+#Function to run several Terraform working directories at the same time
+async def run_terraform_modules(*modules):
+     import asyncio
+
+     return await asyncio.gather(*modules)
+
+#Function to take the advisory lock that serializes configuration writes between controller processes
+@contextmanager
+def config_lock():
+     with open(working_dir + "/.kap.lock", "a+") as file:
+          if os.name == 'nt':
+               import msvcrt
+               file.seek(0)
+               msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+
+          else:
+               import fcntl
+               fcntl.flock(file, fcntl.LOCK_EX)
+
+          try:
+               yield
+
+          finally:
+               if os.name == 'nt':
+                    file.seek(0)
+                    msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+               else:
+                    fcntl.flock(file, fcntl.LOCK_UN)
+
+#Function to read a JSON file
+def read_json(file_path, missing_ok=False):
+     if missing_ok and not (os.path.exists(file_path)):
+          return {}
+
+     with open(file_path, 'r') as file:
+          return json.load(file)
+
+#Function to write a JSON file atomically through a temporary file and a rename
+def write_json(file_path, data):
+     import tempfile
+
+     file_dir = os.path.dirname(os.path.abspath(file_path))
+
+     with tempfile.NamedTemporaryFile('w', dir=file_dir, prefix=".kap-", suffix=".tmp", delete=False) as file:
+          json.dump(data, file)
+          file.flush()
+          os.fsync(file.fileno())
+
+     os.replace(file.name, file_path)
+
+#Function to load a configuration file into the configuration store
+def load_json(name, file_path, missing_ok=False):
+     data = read_json(file_path, missing_ok)
+     config_files[name] = {'path': file_path, 'data': data, 'snapshot': copy.deepcopy(data)}
+
+     return data
+
+#Function to point a stored configuration to another file, which will be fully written on the next save
+def move_json(name, file_path):
+     if config_files[name]['path'] != file_path:
+          config_files[name]['path'] = file_path
+          config_files[name]['snapshot'] = {}
+
+#Function to write the stored configuration values that have changed since they were loaded
+def save_config():
+     with config_lock():
+          for name in config_files.keys():
+               stored = config_files[name]
+               changes = {key: value for key, value in stored['data'].items() if key not in stored['snapshot'] or stored['snapshot'][key] != value}
+
+               if len(changes) == 0:
+                    continue
+
+               #Values changed by other controller processes since the file was loaded are preserved
+               data = read_json(stored['path'], missing_ok=True)
+               data.update(changes)
+               write_json(stored['path'], data)
+
+               stored['snapshot'] = copy.deepcopy(stored['data'])
+
+#Function to load the default arguments from the configuration files
+def load_config():
+     global scriptargs, tfargs, k8sargs, s3args
+
+     scriptargs = load_json('scriptargs', working_dir + "/config.json")
+     tfargs = load_json('tfargs', scriptargs['tf_dir'] + "/Infra_deploy/dev.json")
+     k8sargs = load_json('k8sargs', working_dir + "/k8s_dinamic_vars.json")
+     s3args = load_json('s3args', scriptargs['tf_dir'] + "/s3_deploy/dev.json", missing_ok=True)
+
+     k8sargs.setdefault("bucket_name", "kap-bucket")
+     tfargs.setdefault("node_ami", "")
+     k8sargs.setdefault("artifact_cache", False)
+     k8sargs.setdefault("artifact_checksums", {})
+     k8sargs.setdefault("fs_backup", False)
+     k8sargs.setdefault("restore_mode", "playbook")
+
+#Function to fill the arguments that have not been specified with their configured values
+def default_args(argsdict):
+     defaults = {
+          "n": validate_format(f"{tfargs["num_masters"]}:{tfargs["num_workers"]}"),
+          "kubernetes_version": k8sargs["kubernetes_version"],
+          "tf_dir": scriptargs["tf_dir"],
+          "kube_dir": scriptargs["kube_dir"],
+          "private_key_path": scriptargs["private_key_path"],
+          "s3_credentials_path": scriptargs["s3_credentials_path"],
+          "region": tfargs["region"],
+          "master_instance_type": tfargs["master_instance_type"],
+          "worker_instance_type": tfargs["worker_instance_type"],
+          "service_instance_type": tfargs["service_instance_type"],
+          "bucket_name": k8sargs["bucket_name"],
+          "artifact_cache": k8sargs["artifact_cache"],
+          "fs_backup": k8sargs["fs_backup"],
+          "restore_mode": k8sargs["restore_mode"]
+     }
+
+     for key in defaults.keys():
+          if argsdict[key] == None:
+               argsdict[key] = defaults[key]
+
+     for key in ('artifact_cache', 'fs_backup'):
+          if isinstance(argsdict[key], str):
+               argsdict[key] = argsdict[key] == "true"
+
+#Function to add the specified arguments to their respective variables files
+def add_args(argsdict):
+
+     for key in argsdict.keys():
+          
+          if key in scriptargs.keys():
+               scriptargs[key] = argsdict[key]
+
+          if key in tfargs.keys():
+               tfargs[key] = argsdict[key]
+
+          if key in k8sargs.keys():
+               k8sargs[key] = argsdict[key]
+
+#Function to establish the backup settings
+def backup_setting():
+    if args["backup"] != None:
+         args["backup_name"] = args["backup"]
+         args["backup"] = True
+    
+    elif args["backup"] == None:
+         args["backup_name"] = k8sargs["backup_name"]
+         args["backup"] = False
+
+#Function to calculate the hash of the input configuration of a create: the variables files and the Terraform modules they are applied to
+def config_hash():
+     import hashlib
+
+     inputs = {
+          'tfargs': tfargs,
+          's3args': s3args,
+          'k8sargs': {key: value for key, value in k8sargs.items() if key not in ('lb_address_pub', 'artifact_checksums')},
+          'modules': {str(file_path): file_sha256(file_path) for file_path in sorted(Path(scriptargs["tf_dir"]).glob("*/*.tf"))}
+     }
+
+     return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+#Function to load the checkpoints of the last create, which are discarded unless a resume has been requested with the same configuration
+def load_checkpoints(resume):
+     global checkpoints
+
+     state = read_json(checkpoint_path, missing_ok=True)
+     digest = config_hash()
+
+     if args['resume'] and state.get('config') != digest:
+          print("The configuration has changed since the last create, no phase will be skipped.")
+
+     if not resume or state.get('config') != digest:
+          state = {'config': digest, 'phases': {}}
+          write_json(checkpoint_path, state)
+
+     checkpoints = state
+
+#Function to record that a phase of the create has been completed, with the outputs that validate it on a resume
+def checkpoint(phase, **outputs):
+     if checkpoints['config'] != None:
+          checkpoints['phases'][phase] = dict(outputs, completed=time.time())
+          write_json(checkpoint_path, checkpoints)
+
+#Function to check if a phase of the create can be skipped, because it was completed and its outputs are still valid
+def completed(phase, validate=lambda outputs: True):
+     outputs = checkpoints['phases'].get(phase)
+
+     if outputs != None and validate(outputs):
+          print(f"Skipping the {phase} phase, completed on {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(outputs['completed']))}.")
+          return True
+
+     return False
+
+#Function to obtain the serial and lineage of a Terraform state without parsing the whole file
+def tf_state_version(tf_dir):
+     try:
+          with open(tf_dir + "/terraform.tfstate", 'rb') as file:
+               head = file.read(4096).decode(errors='ignore')
+
+     except FileNotFoundError:
+          return None
+
+     serial = re.search(r'"serial":\s*(\d+)', head)
+     lineage = re.search(r'"lineage":\s*"([^"]+)"', head)
+
+     if serial == None or lineage == None:
+          return None
+
+     return f"{lineage.group(1)}:{serial.group(1)}"
+
+#Function to obtain the inputs of a Terraform module: the hash of its files, its variables and the version of its state
+def tf_inputs(tf_dir):
+     return {
+          'files': {file_path.name: file_sha256(file_path) for file_path in sorted(Path(tf_dir).glob("*.tf"))},
+          'vars': read_json(tf_dir + "/dev.json", missing_ok=True),
+          'state': tf_state_version(tf_dir)
+     }
+
+#Function to record the inputs of a Terraform module once they have been applied
+def record_tf_inputs(tf_dir):
+     inputs = read_json(tf_inputs_path, missing_ok=True)
+     inputs[str(Path(tf_dir).resolve())] = tf_inputs(tf_dir)
+     write_json(tf_inputs_path, inputs)
+
+#Function to obtain the plan arguments of a Terraform module: None if its inputs have not changed since its last apply,
+#a plan targeted to the resources of the changed variables if only they changed, or a full plan otherwise
+def tf_plan_args(tf_dir):
+     previous = read_json(tf_inputs_path, missing_ok=True).get(str(Path(tf_dir).resolve()))
+     current = tf_inputs(tf_dir)
+
+     if args['full_plan'] or previous == None or current['state'] == None or (previous['files'], previous['state']) != (current['files'], current['state']):
+          return []
+
+     changed = sorted(key for key in previous['vars'].keys() | current['vars'].keys() if previous['vars'].get(key) != current['vars'].get(key))
+     targets = tf_var_targets.get(Path(tf_dir).name, {})
+
+     #Variables without known resources, such as the region, may change any resource of the module
+     if not set(changed) <= targets.keys():
+          return []
+
+     resources = sorted({resource for key in changed for resource in targets[key]})
+     if len(resources) == 0:
+          return None
+
+     print(f"Only {', '.join(changed)} changed in {Path(tf_dir).name}, planning {', '.join(resources)} without a refresh...")
+     return ['-refresh=false'] + [f'-target={resource}' for resource in resources]
+
+#Function to obtain the outputs of a Terraform module, cached until its state changes
+@traced("terraform_outputs")
+def terraform_outputs(tf_dir):
+     import subprocess
+
+     cache_path = working_dir + "/.tf_outputs.json"
+     version = tf_state_version(tf_dir)
+     cache = read_json(cache_path, missing_ok=True)
+     cached = cache.get(str(Path(tf_dir).resolve()), {})
+
+     if version != None and cached.get("version") == version:
+          return cached["outputs"]
+
+     process = subprocess.run(['terraform', f'-chdir={tf_dir}', 'output', '-json'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+     if process.returncode != 0:
+          raise Exception(f"Error: terraform output failed in {tf_dir}: {process.stderr.strip()}")
+
+     try:
+          outputs = json.loads(process.stdout)
+     except json.JSONDecodeError:
+          raise Exception(f"Error: terraform output returned invalid JSON in {tf_dir}")
+
+     if len(outputs) == 0:
+          raise Exception(f"Error: no Terraform outputs found in {tf_dir}. Has the infrastructure been deployed?")
+
+     #States without a readable version, such as remote backends, are never cached
+     if version != None:
+          cache[str(Path(tf_dir).resolve())] = {"version": version, "outputs": outputs}
+          write_json(cache_path, cache)
+
+     return outputs
+
+#Function to generate a dynamic Ansible inventory
+@traced("generate_inventory")
+def generate_inventory():
+     
+     inventory = {
+          "all":{
+               "vars":{
+                    "ansible_user": "ubuntu",
+                    "ansible_ssh_private_key_file": f"/home/ubuntu/{Path(scriptargs['private_key_path']).name}",
+                    "ansible_ssh_extra_args": "-o StrictHostKeyChecking=no"
+                },
+                "hosts":{
+                     "control":{
+                        "ansible_host": "localhost"
+                    }
+                },
+                "children":{
+                    "k8snodes":{
+                        "children":{
+                            "mnodes":{},
+                            "wknodes":{}
+                        }
+                    },
+                    "mnodes":{
+                        "children":{
+                            "admin":{},
+                            "managed":{}
+                        }
+                    },
+                    "admin":{
+                         "hosts":{} 
+                    }, 
+                    "managed":{
+                         "hosts":{}
+                    },
+                    "wknodes":{
+                         "hosts":{}
+                    }
+                }
+            }
+     }
+     
+     tf_output = terraform_outputs(scriptargs["tf_dir"] + "/Infra_deploy")
+
+     key = list(tf_output['kmasters_info']['value'].keys())[0]
+     value = tf_output['kmasters_info']['value'][key]
+
+     inventory['all']['children']['admin']['hosts'][key] = {"ansible_host": value}
+     
+
+     for key in list(tf_output['kmasters_info']['value'].keys())[1::]:
+          value = tf_output['kmasters_info']['value'][key]
+          inventory['all']['children']['managed']['hosts'][key] = {"ansible_host": value}
+
+     for key in list(tf_output['kworkers_info']['value'].keys()):
+          value = tf_output['kworkers_info']['value'][key]
+          inventory['all']['children']['wknodes']['hosts'][key] = {"ansible_host": value}
+
+     with open(working_dir + "/inventory.json", 'w') as file:
+          json.dump(inventory, file, indent=4)
+
+     return inventory
+
+#Function to generate an Ansible inventory with the given nodes for the node preparation play
+def node_inventory(hosts):
+     return {
+          "all":{
+               "vars":{
+                    "ansible_user": "ubuntu",
+                    "ansible_ssh_private_key_file": f"/home/ubuntu/{Path(scriptargs['private_key_path']).name}",
+                    "ansible_ssh_extra_args": "-o StrictHostKeyChecking=no"
+               },
+               "children":{
+                    "k8snodes":{
+                         "hosts": {name: {"ansible_host": address} for name, address in hosts.items()}
+                    }
+               }
+          }
+     }
+
+#Function to obtain the Kubernetes nodes of an inventory
+def inventory_hosts(inventory):
+     if len(inventory) == 0:
+          return set()
+
+     children = inventory['all']['children']
+
+     return set(host for group in ('admin', 'managed', 'wknodes') for host in children[group]['hosts'].keys())
+
+#Function to generate an Ansible configuration tuned to the size of the inventory
+def generate_ansible_cfg(inventory):
+     #Only the groups that list hosts are counted, the parent groups just nest them
+     num_hosts = len(inventory['all'].get('hosts', {})) + sum(len(group.get('hosts', {})) for group in inventory['all']['children'].values())
+
+     #Every host gets its own fork, bounded to protect the Service Node's memory
+     forks = min(max(num_hosts, 5), 50)
+
+     ansible_cfg = f"""[defaults]
+inventory = inventory.json
+forks = {forks}
+gathering = smart
+fact_caching = jsonfile
+fact_caching_connection = /home/ubuntu/kap/.facts
+fact_caching_timeout = 86400
+host_key_checking = False
+
+[privilege_escalation]
+become = True
+become_method = sudo
+become_user = root
+become_ask_pass = False
+
+[ssh_connection]
+pipelining = True
+ssh_args = -C -o ControlMaster=auto -o ControlPersist=300s
+control_path_dir = /home/ubuntu/.ansible/cp
+"""
+
+     with open(working_dir + "/ansible_tuned.cfg", 'w') as file:
+          file.write(ansible_cfg)
+
+#Function to close the Ansible task being followed, printing its duration and its slowest host
+def close_ansible_task(task, timestamp):
+     if task == None:
+          return
+
+     task['duration'] = timestamp - task['start']
+     results = ", ".join(f"{status}={list(task['hosts'].values()).count(status)}" for status in sorted(set(task['hosts'].values())))
+     summary = f"[{time.strftime('%H:%M:%S', time.localtime(timestamp))}] {task['name']} ({task['duration']:.1f}s) {results}"
+
+     if len(task['times']) > 1:
+          slowest = max(task['times'], key=task['times'].get)
+          summary = summary + f" - slowest: {slowest} ({task['times'][slowest]:.1f}s)"
+
+     print(summary)
+
+#Function to run an Ansible playbook on a host, following the progress of every task and host
+@traced("run_playbook")
+def run_playbook(ssh_obj, playbook_cmd):
+     run = {'tasks': [], 'recap': {}, 'failures': []}
+     current = {'play': None, 'task': None, 'recap': False}
+
+     #Host results are ordered by severity so that a looped task keeps its worst result
+     severity = ('skipping', 'ok', 'changed', 'failed', 'fatal', 'unreachable')
+
+     def follow(timestamp, name, line):
+          header = re.match(r"^(PLAY|TASK|RUNNING HANDLER) \[(.*)\]", line)
+          result = re.match(r"^(ok|changed|skipping|failed|fatal): \[([^\]]+)\](.*)", line)
+          recap = re.match(r"^(\S+)\s+: ok=(\d+)\s+changed=(\d+)\s+unreachable=(\d+)\s+failed=(\d+)", line)
+
+          if line.startswith("PLAY RECAP"):
+               close_ansible_task(current['task'], timestamp)
+               current['task'] = None
+               current['recap'] = True
+
+          elif header != None and header.group(1) == "PLAY":
+               close_ansible_task(current['task'], timestamp)
+               current['task'] = None
+               current['play'] = header.group(2)
+               print(f"\n[{time.strftime('%H:%M:%S', time.localtime(timestamp))}] PLAY {current['play']}")
+
+          elif header != None:
+               close_ansible_task(current['task'], timestamp)
+               current['task'] = {'play': current['play'], 'name': header.group(2), 'start': timestamp, 'duration': 0, 'hosts': {}, 'times': {}}
+               run['tasks'].append(current['task'])
+
+          elif result != None and current['task'] != None:
+               status, host = result.group(1), result.group(2)
+
+               if status == 'fatal' and "UNREACHABLE!" in result.group(3):
+                    status = 'unreachable'
+
+               if severity.index(status) >= severity.index(current['task']['hosts'].get(host, 'skipping')):
+                    current['task']['hosts'][host] = status
+               current['task']['times'][host] = timestamp - current['task']['start']
+
+               if status in ('failed', 'fatal', 'unreachable'):
+                    run['failures'].append({'play': current['play'], 'task': current['task']['name'], 'host': host, 'status': status, 'msg': result.group(3).lstrip(': ').strip()})
+                    print(f"[{time.strftime('%H:%M:%S', time.localtime(timestamp))}] {status.upper()} {host}: {current['task']['name']}")
+
+          elif line.strip() == "...ignoring" and len(run['failures']) > 0:
+               run['failures'].pop()
+
+          elif current['recap'] and recap != None:
+               run['recap'][recap.group(1)] = {'ok': int(recap.group(2)), 'changed': int(recap.group(3)), 'unreachable': int(recap.group(4)), 'failed': int(recap.group(5))}
+
+     std = ssh_exec(ssh_obj, f"export ANSIBLE_NOCOLOR=1 ANSIBLE_FORCE_COLOR=0; {playbook_cmd}", pty=True)
+     output = stream_read(std, on_line=follow)
+     run['returncode'] = std['stdout'].channel.recv_exit_status()
+     close_ansible_task(current['task'], time.time())
+
+     #Summary of the slowest tasks and of the failures
+     print("\nSlowest tasks:")
+     for task in sorted(run['tasks'], key=lambda task: task['duration'], reverse=True)[:5]:
+          print(f"{task['duration']:.1f}s {task['play']} / {task['name']}")
+
+     if run['returncode'] != 0:
+          print("\nFailures:")
+          for failure in run['failures']:
+               print(f"{failure['host']} ({failure['status']}) in '{failure['task']}': {failure['msg']}")
+
+          if len(run['failures']) == 0:
+               print("\n".join(output['stdout']))
+
+          raise Exception(f"Error: Ansible playbook failed with exit code {run['returncode']} on hosts: {', '.join(sorted(set(failure['host'] for failure in run['failures']))) or 'unknown'}")
+
+     return run
+
+#Function to connect with the Service Node through its pooled SSH connection
+@traced("connect_service_node")
+def connect_service_node():
+
+     #Retrievement of the Service Node infromation
+     ec2 = wait_ec2_instances((ec2_name,), tfargs["region"], 30)[ec2_name]
+
+     #SSH connection establishment with the Service Node
+     ssh = wait_until(f"{ec2_name} SSH", lambda: ssh_session(ec2['PublicDnsName'], ssh_username, scriptargs["private_key_path"]), 120,
+                      fatal=ssh_error_fatal, retry_msg=f"Stablishing SSH connection with host {ec2['PublicDnsName']}...")
+     print(f"Successful SSH connection with host {ec2['PublicDnsName']}")
+
+     return ec2, ssh
+
+#Function to execute the Ansible component
+@traced("k8s_deploy")
+def k8s_deploy():
+
+     #Connection with the Service Node
+     ec2, ssh = connect_service_node()
+
+     #Cluster configuration
+     print("Configuring Cluster...")
+
+     #Verification of the existance of the KAP directory in the Service Node
+     wait_until("KAP directory", lambda: ssh_exec(ssh, "touch /home/ubuntu/kap/")['stdout'].channel.recv_exit_status() == 0, 300,
+                fatal=ssh_error_fatal, retry_msg="Configuring cluster environment...")
+     print("KAP directory found")
+
+     #Modification of the Ansible's variables files with the new Service Node public IP
+     k8sargs["lb_address_pub"] = ec2['PublicDnsName']
+
+     #The artifacts are verified against their checksums, which the Service Node uses to skip their download
+     artifact_files = []
+     if k8sargs["artifact_cache"] == True:
+          artifacts = service_binaries(ssh)
+
+          for name, artifact in artifacts.items():
+               digest, cache_path = cache_artifact(artifact)
+               k8sargs["artifact_checksums"][name] = f"sha256:{digest}"
+               artifact_files.append((cache_path, f"/tmp/{artifact['tmp_path']}", 0o644))
+
+     save_config()
+
+     #Generation of the new inventory file, keeping the previous one to find the nodes added by a scale-out
+     previous_inventory = read_json(working_dir + "/inventory.json", missing_ok=True)
+     inventory = generate_inventory()
+     new_hosts = sorted(inventory_hosts(inventory) - inventory_hosts(previous_inventory))
+     scale_out = args.get('scale_out', False) and len(previous_inventory) != 0 and len(new_hosts) != 0
+
+     #A resumed create only retrieves the kubeconfig when the same nodes were already deployed and the Service Node still holds it
+     hosts = sorted(inventory_hosts(inventory))
+     if completed("deploy", lambda outputs: outputs['hosts'] == hosts and ssh_exec(ssh, "test -s /tmp/kap/kubeconfig")['stdout'].channel.recv_exit_status() == 0):
+          sftp_get_file(ssh, "/tmp/kap/kubeconfig", f"{scriptargs["kube_dir"]}/config")
+          print("The cluster has been succesfully deployed.\n")
+          return
+
+     #Verification that every Kubernetes node to configure passes its status checks before Ansible reaches them
+     print("Waiting for the Kubernetes nodes...")
+     wait_ec2_instances(new_hosts if scale_out else ('kmaster*', 'kworker*'), tfargs["region"], 600, status_ok=True)
+
+     if args['ansible_tuned']:
+          generate_ansible_cfg(inventory)
+
+     #Transmition of the dynamic files, the SSH private key and, if the Cluster Recovery System has been requested, the S3 bucket credentials to the Service Node
+     manifest = [
+          (f"{working_dir}/k8s_dinamic_vars.json", "/home/ubuntu/kap/k8s_dinamic_vars.json", 0o644),
+          (f"{working_dir}/inventory.json", "/home/ubuntu/kap/inventory.json", 0o644),
+          (scriptargs["private_key_path"], f"/home/ubuntu/{Path(scriptargs['private_key_path']).name}", 0o400)
+     ]
+
+     if args['ansible_tuned']:
+          manifest.append((f"{working_dir}/ansible_tuned.cfg", "/home/ubuntu/kap/ansible_tuned.cfg", 0o644))
+
+     if k8sargs["backup"] == True:
+          manifest.append((scriptargs["s3_credentials_path"], f"/home/ubuntu/{Path(scriptargs['s3_credentials_path']).name}", 0o400))
+
+     #Helm and Velero are pushed from the local artifact cache so that the Service Node does not download them
+     if k8sargs["artifact_cache"] == True:
+          ssh_exec(ssh, "mkdir -p " + " ".join(f"/tmp/{name}" for name in artifacts.keys()))
+          manifest += artifact_files
+
+     wait_until("dynamic files upload", lambda: sync_files(ssh, manifest) != None, 30, fatal=ssh_error_fatal, retry_msg="Configuring cluster environment...")
+
+     print("The cluster environment has been successfully configured.")
+
+     #Execution of the Ansible component / playbook
+     print("Deploying Cluster...")
+     playbook_cmd = f"ansible-playbook k8s_deploy.yaml -e node_prep_strategy={args['ansible_strategy']}"
+     if args['ansible_tuned']:
+          playbook_cmd = f"ANSIBLE_CONFIG=/home/ubuntu/kap/ansible_tuned.cfg {playbook_cmd}"
+
+     #A scale-out only prepares and joins the new nodes, refreshing the join script on the first master
+     if scale_out:
+          print(f"Scaling out the cluster with {', '.join(new_hosts)}...")
+          playbook_cmd = f"{playbook_cmd} --limit control,admin,{','.join(new_hosts)} -e scale_out=true"
+
+     run_playbook(ssh, f'cd /home/ubuntu/kap/ && {playbook_cmd}')
+     checkpoint("deploy", hosts=hosts)
+
+     #Retrievement of the kubeconfig file from the Service Node
+     print("Setting local environment...")
+     sftp_get_file(ssh, "/tmp/kap/kubeconfig", f"{scriptargs["kube_dir"]}/config")
+
+     print("The cluster has been succesfully deployed.\n\nTry to execute 'kubectl get nodes' from your working directory.\n\n")
+     print("Execute 'kubectl port-forward -n kubernetes-dashboard service/kubernetes-dashboard-kong-proxy 8443:443' to expose the Kubernetes dashboard.")
+     print("You can access it by seraching 'https://localhost:8443' on your borwser.\n\n")
+     print("Execute kubectl -n kubernetes-dashboard create token admin-user to generate a token to access the Dasboard.\n\n")
+
+#Function to prepare the Kubernetes nodes while Terraform is still creating the rest of them
+@traced("prepare_nodes")
+def prepare_nodes(apply_thread):
+     region = tfargs["region"]
+
+     #The Service Node and the NAT instance are needed before any node can be prepared, unless the apply ends without them
+     print("Waiting for the Service Node...")
+     wait_until("Service Node creation", lambda: not apply_thread.is_alive() or len(get_cluster_nodes(region, (ec2_name, 'NAT'))) == 2, 600,
+                fatal=aws_error_fatal, max_delay=30)
+     if len(get_cluster_nodes(region, (ec2_name, 'NAT'))) != 2:
+          return
+
+     wait_ec2_instances((ec2_name, 'NAT'), region, 600, status_ok=True)
+     ec2, ssh = connect_service_node()
+     wait_until("KAP directory", lambda: ssh_exec(ssh, "touch /home/ubuntu/kap/")['stdout'].channel.recv_exit_status() == 0, 300,
+                fatal=ssh_error_fatal, retry_msg="Configuring cluster environment...")
+
+     #Nodes that were prepared before, by a previous deployment or a baked image, are skipped by the marker that the playbook checks
+     prepared = set()
+     ready = {}
+
+     while True:
+          finished = not apply_thread.is_alive()
+          ready.update(ready_nodes(region))
+          batch = sorted(set(ready.keys()) - prepared)
+
+          if len(batch) != 0:
+               print(f"Preparing {', '.join(batch)}...")
+               write_json(working_dir + "/prep_inventory.json", node_inventory(ready))
+
+               manifest = [
+                    (f"{working_dir}/k8s_dinamic_vars.json", "/home/ubuntu/kap/k8s_dinamic_vars.json", 0o644),
+                    (f"{working_dir}/prep_inventory.json", "/home/ubuntu/kap/prep_inventory.json", 0o644),
+                    (scriptargs["private_key_path"], f"/home/ubuntu/{Path(scriptargs['private_key_path']).name}", 0o400)
+               ]
+
+               playbook_cmd = f"ansible-playbook k8s_init.yaml -i prep_inventory.json --limit {','.join(batch)} -e node_prep_strategy={args['ansible_strategy']}"
+               if args['ansible_tuned']:
+                    generate_ansible_cfg(node_inventory(ready))
+                    manifest.append((f"{working_dir}/ansible_tuned.cfg", "/home/ubuntu/kap/ansible_tuned.cfg", 0o644))
+                    playbook_cmd = f"ANSIBLE_CONFIG=/home/ubuntu/kap/ansible_tuned.cfg {playbook_cmd}"
+
+               wait_until("dynamic files upload", lambda: sync_files(ssh, manifest) != None, 30, fatal=ssh_error_fatal, retry_msg="Configuring cluster environment...")
+
+               run_playbook(ssh, f"cd /home/ubuntu/kap/ && {playbook_cmd}")
+               prepared.update(batch)
+
+          #A last round is made once the apply finishes so that no node is left behind
+          elif finished:
+               return
+
+          else:
+               time.sleep(10)
+
+#Function to run a Terraform apply, preparing the nodes as they come up if the pipelined creation has been requested
+def apply_cluster(coroutine):
+     import asyncio
+
+     if not args['pipelined']:
+          asyncio.run(coroutine)
+          return
+
+     errors = []
+     context = contextvars.copy_context()
+
+     def apply():
+          try:
+               context.run(asyncio.run, coroutine)
+          except Exception as e:
+               errors.append(e)
+
+     apply_thread = threading.Thread(target=apply)
+     apply_thread.start()
+
+     try:
+          prepare_nodes(apply_thread)
+
+     finally:
+          apply_thread.join()
+
+     if len(errors) != 0:
+          raise errors[0]
+
+#Function to deploy Kubernetes on the applied infrastructure and, if the controller handles it, to restore the saved namespaces
+def deploy_cluster():
+     k8s_deploy()
+
+     if k8sargs["backup"] == True and k8sargs["restore_mode"] == "controller" and not completed("restore"):
+          restore_cluster()
+          checkpoint("restore")
+
+#Function to execute the Terraform component
+@traced("create_cluster")
+def create_cluster():
+     import asyncio
+
+     infra_dir = scriptargs["tf_dir"] + "/Infra_deploy"
+     s3_dir = scriptargs["tf_dir"] + "/s3_deploy"
+
+     #Modules whose inputs have not changed since their last apply are neither planned nor applied
+     infra_args = tf_plan_args(infra_dir)
+     s3_args = tf_plan_args(s3_dir) if k8sargs["backup"] == True else None
+
+     #A resumed create, or the create of an unchanged infrastructure, skips the phases completed with the same configuration. -full-plan forces a full redeploy
+     load_checkpoints(args['resume'] or (infra_args == None and s3_args == None))
+
+     if completed("apply", lambda outputs: tf_state_version(infra_dir) == outputs['state']):
+          deploy_cluster()
+          return
+
+     #Deployment of the S3 bucket if the Cluster Recovery System has been requested, at the same time as the cluster plan
+     modules = []
+     if s3_args != None:
+          print("Setting backup storage...")
+          modules.append(run_terraform_module(s3_dir, True, f"-var-file={s3_dir}/dev.json", *s3_args))
+
+     if infra_args == None:
+          print("The infrastructure has not changed since the last apply, skipping its plan and apply.")
+          asyncio.run(run_terraform_modules(*modules))
+          checkpoint("apply", state=tf_state_version(infra_dir))
+          deploy_cluster()
+          return
+
+     a = input("Would you like to check the changes that will be applied to your AWS account before applying? (yes/no)\nOnly 'yes' will be accepted to approve.\n\nEnter value: ")
+
+     if a not in ('yes', 'no'):
+          raise ValueError("Invalid argument. Only yes/no is valid.")
+
+     if a == 'yes':
+
+          #Execution of Terraform plan
+          print("Printing changes...")
+          asyncio.run(run_terraform_modules(*modules, run_terraform_module(infra_dir, False, f"-var-file={infra_dir}/dev.json", *infra_args)))
+
+          b = input("\nWould you like to apply this changes? (yes/no)\nOnly 'yes' will be accepted to approve.\n\nEnter value: ")
+
+          if b not in ('yes', 'no'):
+               raise ValueError("Invalid argument. Only yes/no is valid.")
+     
+          if b == 'yes':
+
+               #Execution of Terraform apply
+               print("Applying changes...")
+               apply_cluster(run_terraform_async('apply', infra_dir, f"{infra_dir}/k8s-plan.tfplan"))
+               record_tf_inputs(infra_dir)
+               checkpoint("apply", state=tf_state_version(infra_dir))
+               deploy_cluster()
+
+          elif b == 'no':
+               print("Apply cancelled.\nPlease contact with the application manager for more information.\n")
+               print(f"If you know what you are doing, change the terraform's main file in {scriptargs["tf_dir"]}/Infra_deploy directory according to your needs.\nWe don't garantee the correct functionality of the application if changes are made.")
+
+     elif a == 'no':
+
+          #Execution of Terraform plan and apply if no validation has been requeted
+          print("Applying changes...")
+          apply_cluster(run_terraform_modules(*modules, run_terraform_module(infra_dir, True, f"-var-file={infra_dir}/dev.json", *infra_args)))
+          checkpoint("apply", state=tf_state_version(infra_dir))
+          deploy_cluster()
+
+#Function to destroy the cluster
+@traced("destroy_cluster")
+def destroy_cluster():
+     import asyncio
+
+     a = input("Do you want to destroy the cluster? (yes/no)\n¡Remember to save your changes on an external datastore if needed!\nOnly 'yes' will be accepted to approve.\n\nEnter value: ")
+
+     if a not in ('yes', 'no'):
+          raise ValueError("Invalid argument. Only yes/no is valid.")
+     
+     if a == 'yes':
+
+          #Execution of Terraform destroy
+          print("Destroying cluster...")
+          asyncio.run(run_terraform_async('destroy', scriptargs["tf_dir"] + "/Infra_deploy", f"-var-file={scriptargs["tf_dir"] + "/Infra_deploy/dev.json"}", "-auto-approve"))
+          if os.path.exists(scriptargs['kube_dir'] + "/config"):
+               print("Removing Kubernetes configuration...\n")
+               os.remove(scriptargs['kube_dir'] + "/config")
+          print("Cluster was destroyed with exit!!!")
+     
+     elif a == 'no':
+          print("Destruction cancelled.")
+
+#Function to access an existing cluster
+@traced("join_cluster")
+def join_cluster():
+
+     #Connection with the Service Node
+     ec2, ssh = connect_service_node()
+
+      #Retrievement of the kubeconfig file from the Service Node
+     print("Setting local environment...")
+     sftp_get_file(ssh, "/home/ubuntu/.kube/config", scriptargs["kube_dir"])
+
+#Function to obtain the Velero objects of a kind (backups, restores) that match a selector, by the name of each object
+def velero_objects(ssh_obj, kind, selector):
+     std = ssh_exec(ssh_obj, f"kubectl get {kind}.velero.io -n velero {selector} -o json")
+     output = std['stdout'].read().decode()
+
+     if std['stdout'].channel.recv_exit_status() != 0:
+          raise Exception(f"Error: unable to list the {kind} matching '{selector}': {std['stderr'].read().decode().strip()}")
+
+     return {item['metadata']['name']: item for item in json.loads(output)['items']}
+
+#Function to save the cluster's resources, with a Velero backup per namespace
+@traced("save_cluster")
+def save_cluster():
+     from datetime import datetime
+
+     backup_name = k8sargs["backup_name"]
+     namespaces = [namespace.strip() for namespace in scriptargs["backup_namespaces"].split(",") if namespace.strip() != ""]
+     backups = {f"{backup_name}-{namespace}": namespace for namespace in namespaces}
+
+     #Verification of the KAP S3 bucket existance
+     wait_until(k8sargs["bucket_name"], lambda: check_s3_bucket(k8sargs["bucket_name"], tfargs["region"]), 30, fatal=aws_error_fatal)
+
+     #Connection with the Service Node
+     ec2, ssh = connect_service_node()
+
+     #Every backup is submitted at once through its own channel, grouped by the name of the save
+     options = f"--labels kap-backup={backup_name}"
+     if k8sargs["fs_backup"] == True:
+          options += " --default-volumes-to-fs-backup"
+     if args['parallel_files_upload'] != None:
+          options += f" --parallel-files-upload {args['parallel_files_upload']}"
+
+     print(f"Saving {', '.join(namespaces)}...")
+     submitted = {name: ssh_exec(ssh, f"velero backup create {name} --include-namespaces {namespace} {options}") for name, namespace in backups.items()}
+
+     for name, std in submitted.items():
+          if std['stdout'].channel.recv_exit_status() != 0:
+               raise Exception(f"Error: backup {name} could not be created: {std['stderr'].read().decode().strip()}")
+
+     #The phases of all the backups are polled in a single request, until each one finishes
+     finished = ('Completed', 'PartiallyFailed', 'Failed', 'FailedValidation')
+     phases = {}
+
+     def poll():
+          items = velero_objects(ssh, 'backups', f"-l kap-backup={backup_name}")
+
+          for name in backups.keys():
+               status = items.get(name, {}).get('status', {})
+               progress = status.get('progress', {})
+               phase = (status.get('phase', 'New'), progress.get('itemsBackedUp', 0))
+
+               if phases.get(name) != phase:
+                    phases[name] = phase
+                    print(f"[{time.strftime('%H:%M:%S')}] {name}: {phase[0]} ({phase[1]}/{progress.get('totalItems', '?')} items)")
+
+          if all(phase[0] in finished for phase in phases.values()):
+               return items
+
+     items = wait_until(f"backup {backup_name}", poll, 3600, fatal=ssh_error_fatal, base_delay=2, max_delay=30)
+
+     #The volume data of every backup is what its pod volume backups uploaded, the Kopia repository of a namespace holds that of all its backups
+     volume_bytes = {}
+     if k8sargs["fs_backup"] == True:
+          for volume_backup in velero_objects(ssh, 'podvolumebackups', f"-l 'velero.io/backup-name in ({','.join(backups.keys())})'").values():
+               name = volume_backup['metadata']['labels']['velero.io/backup-name']
+               volume_bytes[name] = volume_bytes.get(name, 0) + volume_backup.get('status', {}).get('progress', {}).get('bytesDone', 0)
+
+     #Report of the duration, size and throughput of every backup
+     print("\nBackup summary:")
+     failures = []
+
+     for name in backups.keys():
+          status = items[name]['status']
+          duration = (datetime.fromisoformat(status['completionTimestamp']) - datetime.fromisoformat(status['startTimestamp'])).total_seconds() if 'completionTimestamp' in status else 0
+          size = s3_prefix_size(k8sargs["bucket_name"], tfargs["region"], f"backups/{name}/") + volume_bytes.get(name, 0)
+
+          print(f"{name}: {status['phase']} in {duration:.0f}s, {size / 2**20:.1f}MB ({size / 2**20 / max(duration, 1):.1f}MB/s), "
+                f"{status.get('errors', 0)} errors, {status.get('warnings', 0)} warnings")
+
+          if status['phase'] != 'Completed':
+               failures.append(name)
+
+     if len(failures) != 0:
+          raise Exception(f"Error: backups {', '.join(failures)} did not complete. Check them with 'velero backup logs <name>' on the Service Node.")
+
+     print("Cluster saved succesfully!!")
+
+#Function to obtain the namespaces of the cluster whose pods are all ready, ignoring the pods that already finished
+def ready_namespaces(ssh_obj, namespaces):
+     std = ssh_exec(ssh_obj, "kubectl get pods -A -o json")
+     output = std['stdout'].read().decode()
+
+     if std['stdout'].channel.recv_exit_status() != 0:
+          raise Exception(f"Error: unable to list the pods of the cluster: {std['stderr'].read().decode().strip()}")
+
+     ready = set(namespaces)
+     for pod in json.loads(output)['items']:
+          conditions = {condition['type']: condition['status'] for condition in pod['status'].get('conditions', [])}
+
+          if pod['status'].get('phase') != 'Succeeded' and conditions.get('Ready') != 'True':
+               ready.discard(pod['metadata']['namespace'])
+
+     return ready
+
+#Function to restore the namespaces of a save, the prioritized ones first, and to follow them until their workloads are ready
+@traced("restore_cluster")
+def restore_cluster():
+     backup_name = k8sargs["backup_name"]
+     priority = [namespace.strip() for namespace in (args['restore_priority'] or "").split(",") if namespace.strip() != ""]
+
+     #Connection with the Service Node
+     ec2, ssh = connect_service_node()
+
+     #A freshly installed Velero needs some time to synchronize the backups of the bucket. Saves made before the per-namespace backups are a single backup named after the save
+     def find_backups():
+          return velero_objects(ssh, 'backups', f"-l kap-backup={backup_name}") or velero_objects(ssh, 'backups', f"--field-selector metadata.name={backup_name}") or None
+
+     print(f"Looking for the backups of {backup_name}...")
+     backups = wait_until(f"backups of {backup_name}", find_backups, 300,
+                          fatal=ssh_error_fatal, retry_msg="Waiting for Velero to synchronize the backups...", base_delay=5, max_delay=15)
+
+     namespaces = {}
+     for name, backup in backups.items():
+          if backup['status'].get('phase') in ('Completed', 'PartiallyFailed'):
+               for namespace in backup['spec'].get('includedNamespaces', []):
+                    namespaces[namespace] = name
+
+     if len(namespaces) == 0:
+          raise Exception(f"Error: {backup_name} has no completed backups to restore.")
+
+     order = [namespace for namespace in priority if namespace in namespaces] + sorted(set(namespaces) - set(priority))
+     stamp = time.strftime('%Y%m%d%H%M%S')
+     restore_id = f"{backup_name}-{stamp}"
+     restores = {f"{backup_name}-{namespace}-{stamp}": namespace for namespace in order}
+
+     #The prioritized restores are created one after another so that Velero queues them in order, the rest of them at once
+     print(f"Restoring {', '.join(order)}...")
+     start = time.monotonic()
+     submitted = {}
+
+     for name, namespace in restores.items():
+          submitted[name] = ssh_exec(ssh, f"velero restore create {name} --from-backup {namespaces[namespace]} --include-namespaces {namespace} --labels kap-restore={restore_id}")
+
+          if namespace in priority and submitted[name]['stdout'].channel.recv_exit_status() != 0:
+               raise Exception(f"Error: restore {name} could not be created: {submitted[name]['stderr'].read().decode().strip()}")
+
+     for name, std in submitted.items():
+          if std['stdout'].channel.recv_exit_status() != 0:
+               raise Exception(f"Error: restore {name} could not be created: {std['stderr'].read().decode().strip()}")
+
+     #The restores and the pods of the restored namespaces are polled in a single request each, until every namespace is ready or failed
+     finished = ('Completed', 'PartiallyFailed', 'Failed', 'FailedValidation')
+     phases, restored_at, ready_at = {}, {}, {}
+
+     def poll():
+          items = velero_objects(ssh, 'restores', f"-l kap-restore={restore_id}")
+
+          for name, namespace in restores.items():
+               status = items.get(name, {}).get('status', {})
+               phase = status.get('phase', 'New')
+
+               if phases.get(name) != phase:
+                    phases[name] = phase
+                    print(f"[{time.strftime('%H:%M:%S')}] {namespace}: {phase}")
+
+               if phase in finished:
+                    restored_at.setdefault(namespace, time.monotonic() - start)
+
+          pending = [namespace for name, namespace in restores.items() if phases[name] in ('Completed', 'PartiallyFailed') and namespace not in ready_at]
+          if len(pending) != 0:
+               for namespace in ready_namespaces(ssh, pending):
+                    ready_at[namespace] = time.monotonic() - start
+                    print(f"[{time.strftime('%H:%M:%S')}] {namespace}: Ready after {ready_at[namespace]:.0f}s")
+
+          if all(phases[name] in finished and (namespace in ready_at or phases[name] not in ('Completed', 'PartiallyFailed')) for name, namespace in restores.items()):
+               return items
+
+     items = wait_until(f"restore {backup_name}", poll, 1800, fatal=ssh_error_fatal, base_delay=2, max_delay=15)
+
+     #Report of the time to restore and the time to ready of every namespace, in restore order
+     print("\nRestore summary:")
+     failures = []
+
+     for name, namespace in restores.items():
+          status = items[name]['status']
+          print(f"{namespace}: {status['phase']} after {restored_at[namespace]:.0f}s, "
+                f"{f'ready after {ready_at[namespace]:.0f}s' if namespace in ready_at else 'not ready'}, "
+                f"{status.get('progress', {}).get('itemsRestored', 0)} items, {status.get('errors', 0)} errors, {status.get('warnings', 0)} warnings")
+
+          if status['phase'] != 'Completed':
+               failures.append(name)
+
+     if len(failures) != 0:
+          raise Exception(f"Error: restores {', '.join(failures)} did not complete. Check them with 'velero restore logs <name>' on the Service Node.")
+
+     print("Cluster restored succesfully!!")
+
+#Function to list the objects of the bucket that belong to the backups of a save, with the Kopia repositories of their namespaces
+def backup_objects(s3_name, aws_region, backup_name):
+     s3 = aws_client('s3', aws_region)
+     paginator = s3.get_paginator('list_objects_v2')
+     candidates, objects, namespaces = {}, {}, set()
+
+     for page in paginator.paginate(Bucket=s3_name, Prefix=f"backups/{backup_name}"):
+          for item in page.get('Contents', []):
+               name = item['Key'].split("/")[1]
+
+               if name == backup_name or name.startswith(backup_name + "-"):
+                    candidates.setdefault(name, []).append(item)
+
+     #A backup belongs to the save if it is named after it, or if it carries its label, since the name of another save may start with this one
+     for name, items in candidates.items():
+          try:
+               backup = json.loads(s3.get_object(Bucket=s3_name, Key=f"backups/{name}/velero-backup.json")['Body'].read())
+
+          except s3.exceptions.NoSuchKey:
+               backup = {'metadata': {}, 'spec': {}}
+
+          if name == backup_name or backup['metadata'].get('labels', {}).get('kap-backup') == backup_name:
+               objects.update({item['Key']: item for item in items})
+               namespaces.update(backup['spec'].get('includedNamespaces', []))
+
+     for namespace in sorted(namespaces - {"*"}):
+          for page in paginator.paginate(Bucket=s3_name, Prefix=f"kopia/{namespace}/"):
+               for item in page.get('Contents', []):
+                    objects[item['Key']] = item
+
+     return objects
+
+#Function to verify a file against an S3 ETag, which is the MD5 of the object or, for multipart uploads, the MD5 of the MD5 of every part
+def verify_etag(file_path, etag, part_size):
+     import hashlib
+
+     etag = etag.strip('"')
+     digests = []
+
+     with open(file_path, 'rb') as file:
+          while True:
+               digest, remaining = hashlib.md5(), part_size
+
+               for chunk in iter(lambda: file.read(min(1024 * 1024, remaining)), b''):
+                    digest.update(chunk)
+                    remaining -= len(chunk)
+
+               if remaining == part_size and len(digests) != 0:
+                    break
+
+               digests.append(digest)
+
+               if remaining != 0:
+                    break
+
+     if "-" in etag:
+          return f"{hashlib.md5(b''.join(digest.digest() for digest in digests)).hexdigest()}-{len(digests)}" == etag
+
+     return digests[0].hexdigest() == etag
+
+#Function to download the backups of a save to a local directory through parallel ranged requests, resuming the objects left half downloaded
+@traced("export_backup")
+def export_backup():
+     from concurrent.futures import ThreadPoolExecutor, as_completed
+
+     backup_name = k8sargs["backup_name"]
+     s3_name = k8sargs["bucket_name"]
+     export_dir = f"{args['export_dir'] or working_dir + '/exports'}/{backup_name}"
+     s3 = aws_client('s3', tfargs["region"])
+
+     #Verification of the KAP S3 bucket existance
+     wait_until(s3_name, lambda: check_s3_bucket(s3_name, tfargs["region"]), 30, fatal=aws_error_fatal)
+
+     objects = backup_objects(s3_name, tfargs["region"], backup_name)
+     if len(objects) == 0:
+          raise Exception(f"Error: {backup_name} has no backups in {s3_name}.")
+
+     #The manifest lists every object of the save and whether it has been exported and verified, and every partial download keeps the parts it already holds in a sidecar file
+     exported = read_json(export_dir + "/kap-export.json", missing_ok=True).get('objects', {})
+     manifest = {'complete': False, 'objects': {key: {'etag': item['ETag'], 'size': item['Size'], 'exported': False} for key, item in objects.items()}}
+     pending, parts = {}, []
+
+     for key, item in objects.items():
+          dest_path = f"{export_dir}/{key}"
+
+          if exported.get(key, {}).get('exported') and exported[key]['etag'] == item['ETag'] and os.path.exists(dest_path) and os.path.getsize(dest_path) == item['Size']:
+               manifest['objects'][key]['exported'] = True
+               continue
+
+          os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+          sidecar = read_json(dest_path + ".kappart.json", missing_ok=True)
+
+          if sidecar.get('etag') != item['ETag'] or not os.path.exists(dest_path + ".kappart"):
+               sidecar = {'etag': item['ETag'], 'done': []}
+
+               with open(dest_path + ".kappart", 'wb') as file:
+                    file.truncate(item['Size'])
+
+          pending[key] = sidecar
+          parts += [(key, offset // transfer_chunk, offset, min(transfer_chunk, item['Size'] - offset))
+                    for offset in range(0, item['Size'], transfer_chunk) if offset // transfer_chunk not in sidecar['done']]
+
+     #Every part is streamed to its offset of the partial file, so only a buffer per worker is held in memory
+     def fetch(key, number, offset, length):
+          response = s3.get_object(Bucket=s3_name, Key=key, Range=f"bytes={offset}-{offset + length - 1}", IfMatch=objects[key]['ETag'])
+
+          with open(f"{export_dir}/{key}.kappart", 'r+b') as file:
+               file.seek(offset)
+
+               for chunk in response['Body'].iter_chunks(1024 * 1024):
+                    file.write(chunk)
+
+          return key, number
+
+     #Verification of a complete object against its ETag, the part size of a multipart upload is that of its first part
+     def finish(key):
+          dest_path = f"{export_dir}/{key}"
+          etag = objects[key]['ETag']
+          part_size = s3.head_object(Bucket=s3_name, Key=key, PartNumber=1)['ContentLength'] if "-" in etag else max(objects[key]['Size'], 1)
+
+          if not verify_etag(dest_path + ".kappart", etag, part_size):
+               os.remove(dest_path + ".kappart")
+               os.remove(dest_path + ".kappart.json")
+               raise Exception(f"Error: checksum mismatch for {key}. Run the export again to download it from scratch.")
+
+          os.replace(dest_path + ".kappart", dest_path)
+          if os.path.exists(dest_path + ".kappart.json"):
+               os.remove(dest_path + ".kappart.json")
+          manifest['objects'][key]['exported'] = True
+
+     size = sum(length for key, number, offset, length in parts)
+     print(f"Exporting {len(pending)} of {len(objects)} objects of {backup_name} ({size / 2**20:.1f}MB) to {export_dir}...")
+     start = time.monotonic()
+
+     try:
+          for key in [key for key in pending.keys() if objects[key]['Size'] == 0 or len(pending[key]['done']) * transfer_chunk >= objects[key]['Size']]:
+               finish(key)
+
+          #After a failed part the queued ones are cancelled, while those already running are still recorded for the next export
+          errors = []
+
+          with ThreadPoolExecutor(max_workers=scriptargs.get("aws_max_pool_connections", 10)) as executor:
+               futures = [executor.submit(fetch, *part) for part in parts]
+
+               for future in as_completed(futures):
+                    if future.cancelled():
+                         continue
+
+                    if future.exception() != None:
+                         errors.append(future.exception())
+                         for queued in futures:
+                              queued.cancel()
+                         continue
+
+                    key, number = future.result()
+                    pending[key]['done'].append(number)
+                    write_json(f"{export_dir}/{key}.kappart.json", pending[key])
+
+                    if len(pending[key]['done']) * transfer_chunk >= objects[key]['Size']:
+                         finish(key)
+
+          if len(errors) != 0:
+               raise errors[0]
+
+     #The manifest is only marked complete once every object has been downloaded and verified, so that a failed export is never imported
+     finally:
+          manifest['complete'] = all(item['exported'] for item in manifest['objects'].values())
+          write_json(export_dir + "/kap-export.json", manifest)
+
+     duration = time.monotonic() - start
+     print(f"Backup {backup_name} exported succesfully in {duration:.0f}s ({size / 2**20 / max(duration, 0.001):.1f}MB/s)!!")
+
+#Function to upload an exported save to the bucket through parallel multipart uploads, verifying every object against its new ETag
+@traced("import_backup")
+def import_backup():
+     from concurrent.futures import ThreadPoolExecutor
+     from boto3.s3.transfer import TransferConfig
+
+     backup_name = k8sargs["backup_name"]
+     s3_name = k8sargs["bucket_name"]
+     export_dir = f"{args['export_dir'] or working_dir + '/exports'}/{backup_name}"
+     s3 = aws_client('s3', tfargs["region"])
+     workers = scriptargs.get("aws_max_pool_connections", 10)
+
+     manifest = read_json(export_dir + "/kap-export.json", missing_ok=True)
+     if len(manifest.get('objects', {})) == 0:
+          raise Exception(f"Error: no export of {backup_name} was found in {export_dir}.")
+
+     #Only a complete export, whose files are all still on disk, can be imported
+     missing = [key for key, item in manifest['objects'].items() if not os.path.exists(f"{export_dir}/{key}") or os.path.getsize(f"{export_dir}/{key}") != item['size']]
+
+     if not manifest.get('complete'):
+          raise Exception(f"Error: the export of {backup_name} in {export_dir} is incomplete. Run the export again to finish it.")
+
+     if len(missing) != 0:
+          raise Exception(f"Error: the export of {backup_name} is missing {', '.join(missing)}. Run the export again to download them.")
+
+     #Verification of the KAP S3 bucket existance
+     wait_until(s3_name, lambda: check_s3_bucket(s3_name, tfargs["region"]), 30, fatal=aws_error_fatal)
+
+     config = TransferConfig(multipart_threshold=transfer_chunk, multipart_chunksize=transfer_chunk, max_concurrency=workers)
+
+     def upload(key):
+          s3.upload_file(f"{export_dir}/{key}", s3_name, key, Config=config)
+
+          if not verify_etag(f"{export_dir}/{key}", s3.head_object(Bucket=s3_name, Key=key)['ETag'], transfer_chunk):
+               raise Exception(f"Error: checksum mismatch for {key} after its upload.")
+
+     #Small objects are uploaded side by side, large ones one after another with their parts in parallel, so that the connection pool is never exceeded
+     sizes = {key: item['size'] for key, item in manifest['objects'].items()}
+     print(f"Importing {len(sizes)} objects of {backup_name} ({sum(sizes.values()) / 2**20:.1f}MB) to {s3_name}...")
+     start = time.monotonic()
+
+     with ThreadPoolExecutor(max_workers=workers) as executor:
+          list(executor.map(upload, [key for key, size in sizes.items() if size < transfer_chunk]))
+
+     for key in sorted((key for key, size in sizes.items() if size >= transfer_chunk), key=lambda key: -sizes[key]):
+          upload(key)
+
+     duration = time.monotonic() - start
+     print(f"Backup {backup_name} imported succesfully in {duration:.0f}s ({sum(sizes.values()) / 2**20 / max(duration, 0.001):.1f}MB/s)!!")
+     print("Velero will list it once it synchronizes the backups of the bucket.")
+
+#Function to obtain the architecture of the Kubernetes nodes, which masters and workers share because they boot from the same image
+def node_architecture(client):
+     instance_types = client.describe_instance_types(InstanceTypes=sorted({tfargs["master_instance_type"], tfargs["worker_instance_type"]}))['InstanceTypes']
+     archs = {instance_type['InstanceType']: 'arm64' if 'arm64' in instance_type['ProcessorInfo']['SupportedArchitectures'] else 'x86_64' for instance_type in instance_types}
+
+     if len(set(archs.values())) != 1:
+          raise Exception(f"Error: the master and worker instance types have different architectures ({', '.join(f'{name}: {arch}' for name, arch in archs.items())}). Use instance types of the same architecture.")
+
+     return list(archs.values())[0]
+
+#Function to find the newest node image baked for the configured Kubernetes version and node architecture
+def find_node_ami(aws_region):
+     client = aws_client('ec2', aws_region)
+     arch = node_architecture(client)
+
+     images = client.describe_images(Owners=['self'], Filters=[
+          {'Name': 'tag:kap-image', 'Values': ['node']},
+          {'Name': 'tag:kubernetes_version', 'Values': [str(k8sargs["kubernetes_version"])]},
+          {'Name': 'architecture', 'Values': [arch]},
+          {'Name': 'state', 'Values': ['available']}
+     ])['Images']
+
+     if len(images) == 0:
+          return ""
+
+     return max(images, key=lambda image: image['CreationDate'])['ImageId']
+
+#Function to bake a node image with the Kubernetes packages already installed
+@traced("bake_image")
+def bake_image():
+     region = tfargs["region"]
+     version = str(k8sargs["kubernetes_version"])
+     client = aws_client('ec2', region)
+
+     #The builder is prepared from the Service Node of a deployed cluster, inside its private subnet
+     ec2, ssh = connect_service_node()
+
+     subnets = client.describe_subnets(Filters=[{'Name': 'vpc-id', 'Values': [ec2['VpcId']]}, {'Name': 'tag:Name', 'Values': ['k8s_priv_subnet']}])['Subnets']
+     groups = client.describe_security_groups(Filters=[{'Name': 'vpc-id', 'Values': [ec2['VpcId']]}, {'Name': 'group-name', 'Values': ['k8s_sec_group']}])['SecurityGroups']
+
+     if len(subnets) == 0 or len(groups) == 0:
+          raise Exception("Error: the cluster network was not found. Deploy a cluster before baking an image.")
+
+     #The builder boots from the Service Node image, which has to match the architecture of the nodes
+     arch = node_architecture(client)
+     service_arch = client.describe_images(ImageIds=[ec2['ImageId']])['Images'][0]['Architecture']
+
+     if service_arch != arch:
+          raise Exception(f"Error: the Service Node image is {service_arch} but the nodes are {arch}. Bake the image from a cluster whose nodes share the Service Node architecture.")
+
+     print("Launching image builder...")
+     builder = client.run_instances(
+          ImageId=ec2['ImageId'],
+          InstanceType=tfargs["worker_instance_type"],
+          KeyName=tfargs["key_name"],
+          SubnetId=subnets[0]['SubnetId'],
+          SecurityGroupIds=[groups[0]['GroupId']],
+          MinCount=1,
+          MaxCount=1,
+          TagSpecifications=[{'ResourceType': 'instance', 'Tags': [{'Key': 'Name', 'Value': 'kbuilder'}]}]
+     )['Instances'][0]
+
+     try:
+          nodes = wait_ec2_instances(('kbuilder',), region, 600, status_ok=True)
+
+          #The builder is the only node of its inventory
+          write_json(working_dir + "/bake_inventory.json", node_inventory({'kbuilder': nodes['kbuilder']['PrivateIpAddress']}))
+
+          manifest = [
+               (f"{working_dir}/k8s_dinamic_vars.json", "/home/ubuntu/kap/k8s_dinamic_vars.json", 0o644),
+               (f"{working_dir}/bake_inventory.json", "/home/ubuntu/kap/bake_inventory.json", 0o644),
+               (scriptargs["private_key_path"], f"/home/ubuntu/{Path(scriptargs['private_key_path']).name}", 0o400)
+          ]
+          wait_until("dynamic files upload", lambda: sync_files(ssh, manifest) != None, 30, fatal=ssh_error_fatal, retry_msg="Configuring builder environment...")
+
+          print("Preparing image builder...")
+          run_playbook(ssh, 'cd /home/ubuntu/kap/ && ansible-playbook k8s_init.yaml -i bake_inventory.json')
+
+          #The apt proxy belongs to this cluster's Service Node, so it is not baked into the image
+          std = ssh_exec(ssh, "cd /home/ubuntu/kap/ && ansible k8snodes -i bake_inventory.json -b -m file -a 'path=/etc/apt/apt.conf.d/01kap-proxy state=absent'")
+          if std['stdout'].channel.recv_exit_status() != 0:
+               raise Exception(f"Error: unable to remove the apt proxy from the image builder: {std['stdout'].read().decode().strip()}")
+
+          #Creation of the image, tagged so that the deployments can find it
+          print("Baking image...")
+          image_id = client.create_image(
+               InstanceId=builder['InstanceId'],
+               Name=f"kap-node-{version}-{arch}-{time.strftime('%Y%m%d%H%M%S')}",
+               TagSpecifications=[{'ResourceType': 'image', 'Tags': [
+                    {'Key': 'kap-image', 'Value': 'node'},
+                    {'Key': 'kubernetes_version', 'Value': version},
+                    {'Key': 'arch', 'Value': arch}
+               ]}]
+          )['ImageId']
+          client.get_waiter('image_available').wait(ImageIds=[image_id], WaiterConfig={'Delay': 15, 'MaxAttempts': 80})
+
+     finally:
+          client.terminate_instances(InstanceIds=[builder['InstanceId']])
+
+     print(f"Image {image_id} baked for Kubernetes {version} ({arch}). New nodes will boot from it.")
+
+#Function to prepare the working directory of a fleet cluster, isolating its configuration and Terraform state
+def prepare_fleet_cluster(cluster):
+     import shutil
+
+     cluster_dir = f"{working_dir}/fleet/{cluster['name']}"
+
+     #The cluster inherits the current configuration the first time it is deployed
+     if not (os.path.isdir(cluster_dir)):
+          os.makedirs(cluster_dir + "/.kube")
+
+          write_json(cluster_dir + "/config.json", dict(scriptargs, tf_dir=cluster_dir + "/terraform", kube_dir=cluster_dir + "/.kube"))
+          write_json(cluster_dir + "/k8s_dinamic_vars.json", k8sargs)
+
+     #The Terraform modules are refreshed on every run so that their changes reach the cluster, keeping its state and its dev.json
+     for module in ('Infra_deploy', 's3_deploy'):
+          src_dir, dest_dir = f"{scriptargs['tf_dir']}/{module}", f"{cluster_dir}/terraform/{module}"
+          if not (os.path.isdir(src_dir)):
+               continue
+
+          kept = ('dev.json',) if os.path.isdir(dest_dir) else ()
+          shutil.copytree(src_dir, dest_dir, dirs_exist_ok=True,
+                          ignore=shutil.ignore_patterns('.terraform', '.terraform.lock.hcl', '*.tfstate*', '*.tfplan', *kept))
+
+          #Module files removed from the source are removed from the cluster as well
+          for file_path in Path(dest_dir).glob("*.tf"):
+               if not os.path.exists(f"{src_dir}/{file_path.name}"):
+                    file_path.unlink()
+
+     return cluster_dir
+
+#Function to run a subcommand of the controller for a fleet cluster in its own working directory
+def run_fleet_cluster(cluster, action):
+     import subprocess
+
+     cluster_dir = prepare_fleet_cluster(cluster)
+
+     cmd = [sys.executable, os.path.dirname(os.path.abspath(__file__)) + "/kap_v2.py", action]
+     for key, value in cluster.get('args', {}).items():
+          if value is True:
+               cmd.append(f"-{key}")
+          elif value is not False:
+               cmd += [f"-{key}", str(value)]
+
+     #The interactive questions are answered in advance: create applies without reviewing the plan, destroy has already been confirmed
+     answers = {'create': "no\n", 'destroy': "yes\n"}.get(action, "")
+
+     start = time.time()
+     process = subprocess.Popen(cmd, cwd=cluster_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True, encoding='utf-8', errors='replace', env=dict(os.environ, PYTHONUNBUFFERED="1"))
+     process.stdin.write(answers)
+     process.stdin.close()
+
+     output = stream_read({'stdout': process.stdout, 'stderr': process.stderr}, tail=20, prefix=cluster['name'])
+
+     return {'name': cluster['name'], 'returncode': process.wait(), 'duration': time.time() - start, 'output': output}
+
+#Function to run a subcommand on every cluster of a fleet at the same time, with a bounded number of workers
+@traced("fleet")
+def run_fleet(fleet_file, action, workers):
+     from concurrent.futures import ThreadPoolExecutor
+
+     clusters = read_json(fleet_file)
+
+     #Clusters are discovered by their tags in each region, and bucket names are global
+     regions = [cluster.get('args', {}).get('region', tfargs['region']) for cluster in clusters]
+     buckets = [cluster.get('args', {}).get('bucket-name', k8sargs['bucket_name']) for cluster in clusters if 'backup' in cluster.get('args', {})]
+     names = [cluster['name'] for cluster in clusters]
+
+     #The cluster of the working directory uses the same tags, so its region is not available to the fleet
+     if tfargs['region'] in regions:
+          raise Exception(f"Error: Every cluster of the fleet needs a region other than {tfargs['region']}, the region of the current cluster.")
+
+     for values, description in ((names, "names"), (regions, "regions"), (buckets, "bucket names")):
+          if len(set(values)) != len(values):
+               raise Exception(f"Error: Every cluster of the fleet needs different {description}.")
+
+     if action == 'destroy':
+          a = input(f"Do you want to destroy the clusters {', '.join(names)}? (yes/no)\nOnly 'yes' will be accepted to approve.\n\nEnter value: ")
+
+          if a not in ('yes', 'no'):
+               raise ValueError("Invalid argument. Only yes/no is valid.")
+
+          if a == 'no':
+               print("Destruction cancelled.")
+               return
+
+     with ThreadPoolExecutor(max_workers=workers) as executor:
+          results = list(executor.map(lambda cluster: run_fleet_cluster(cluster, action), clusters))
+
+     #Aggregated results per cluster
+     print(f"\nFleet {action} results:")
+     for result in results:
+          print(f"{result['name']}: {'succeeded' if result['returncode'] == 0 else 'failed'} in {result['duration']:.1f}s")
+
+          if result['returncode'] != 0:
+               for line in list(result['output']['stdout'])[-5:] + list(result['output']['stderr'])[-5:]:
+                    print(f"     {line}")
+
+     if any(result['returncode'] != 0 for result in results):
+          raise Exception(f"Error: fleet {action} failed for {', '.join(result['name'] for result in results if result['returncode'] != 0)}.")
+
+#Function to validate the format of the -n option
+def validate_format(valor):
+    try:
+        masters, workers = valor.split(":")
+        return {'num_masters':int(masters), 'num_workers':int(workers)}
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{valor}' no tiene el formato int:int (ejemplo: 5:10)")
+    
+#Function to verify that de-scaling has not been requested
+def validate_scaling():
+    args["scale_out"] = False
+
+    try:  
+        get_ec2_info(ec2_name, args["region"])
+       
+    except Exception:
+         return
+    
+    print("A cluster was found. Applying modifications...")
+
+    #The requested dimensions are compared with the deployed nodes, since any subcommand may have stored other ones in the variables file
+    nodes = get_cluster_nodes(args["region"], ('kmaster*', 'kworker*'))
+    num_masters = len([name for name in nodes.keys() if name.startswith('kmaster')])
+    num_workers = len([name for name in nodes.keys() if name.startswith('kworker')])
+
+    if args["num_masters"] < num_masters or args["num_workers"] < num_workers:
+          raise Exception(f"De-scalation is not supported. The cluster has {num_masters} masters and {num_workers} workers. To de-scale, destroy and redeploy the cluster with the desired dimentions.")
+
+    #Scale-outs only deploy the new nodes
+    args["scale_out"] = args["num_masters"] > num_masters or args["num_workers"] > num_workers
+
+#Arguments declaration
+parse = argparse.ArgumentParser()
+parse.add_argument("mode", choices=['create','destroy', 'join-cluster', 'reset-args', 'list-args', 'save', 'restore', 'export', 'import', 'fleet', 'bake-image'])
+parse.add_argument("-n", default=None, type=validate_format)
+parse.add_argument("-kubernetes-version", default=None)
+parse.add_argument("-tf-dir", default=None)
+parse.add_argument("-kube-dir", default=None)
+parse.add_argument("-private-key-path", default=None)
+parse.add_argument("-s3-credentials-path", default=None)
+parse.add_argument("-backup-namespaces", default="default")
+parse.add_argument("-region", default=None)
+parse.add_argument("-instance-type", default=None)
+parse.add_argument("-master-instance-type", default=None)
+parse.add_argument("-worker-instance-type", default=None)
+parse.add_argument("-service-instance-type", default=None)
+parse.add_argument("-backup", default=None)
+parse.add_argument("-bucket-name", default=None)
+parse.add_argument("-artifact-cache", choices=['true', 'false'], default=None)
+parse.add_argument("-fs-backup", choices=['true', 'false'], default=None)
+parse.add_argument("-parallel-files-upload", type=int, default=None)
+parse.add_argument("-restore-mode", choices=['playbook', 'controller'], default=None)
+parse.add_argument("-restore-priority", default=None)
+parse.add_argument("-export-dir", default=None)
+parse.add_argument("-ansible-tuned", action="store_true")
+parse.add_argument("-ansible-strategy", choices=['linear', 'free'], default="linear")
+parse.add_argument("-pipelined", action="store_true")
+parse.add_argument("-resume", action="store_true")
+parse.add_argument("-full-plan", action="store_true", help="plan every module with a refresh and redeploy the cluster, even if nothing changed since the last create")
+parse.add_argument("-trace", default=None)
+parse.add_argument("-trace-format", choices=['chrome', 'otlp'], default="chrome")
+parse.add_argument("-fleet-file", default="fleet.json")
+parse.add_argument("-fleet-action", choices=['create', 'destroy', 'save'], default="create")
+parse.add_argument("-fleet-workers", type=int, default=4)
+
+#Function to process the arguments of a run and execute the requested subcommand
+def main():
+     global args, trace_usage
+
+     #Arguments processing
+     args = vars(parse.parse_args())
+
+     #Export of the trace when the run finishes, even if it fails
+     if args['trace'] != None:
+          trace_usage = True
+          atexit.register(print_trace_summary)
+          atexit.register(export_trace, args['trace'], args['trace_format'])
+
+     #The configuration files are only read once a subcommand has been requested
+     load_config()
+     default_args(args)
+
+     args["key_name"] = Path(args['private_key_path']).stem
+
+     if args['instance_type'] != None: 
+          for key in ('master_instance_type', 'worker_instance_type', 'service_instance_type'):
+             args[key] = args['instance_type']
+
+     args.update(args['n'])
+
+     #Only the create subcommand needs to reach AWS before the arguments are stored
+     if args['mode'] == "create":
+          validate_scaling()
+
+     backup_setting()
+
+     add_args(args)
+
+     #New nodes boot from the newest image baked for the requested Kubernetes version
+     if args['mode'] == "create":
+          tfargs["node_ami"] = find_node_ami(tfargs["region"])
+
+     s3args.update({"region":tfargs["region"], "bucket_name":k8sargs["bucket_name"]})
+
+     move_json('tfargs', scriptargs["tf_dir"] + "/Infra_deploy/dev.json")
+     move_json('s3args', scriptargs["tf_dir"] + "/s3_deploy/dev.json")
+     save_config()
+
+     #Subcommands processing
+     if args['mode'] == "create":
+          create_cluster()
+
+     elif args['mode'] == "destroy":
+          destroy_cluster()
+
+     elif args['mode'] == "reset-args":
+          scriptargs.update({
+               "kube_dir": "", 
+               "tf_dir": "", 
+               "private_key_path": "", 
+               "s3_credentials_path": "", 
+               "backup_namespaces": "default",
+               "aws_max_pool_connections": 10,
+               "aws_max_attempts": 10
+          })
+          tfargs.update({
+               "region": "eu-west-3", 
+               "key_name": "", 
+               "master_instance_type": "t4g.small", 
+               "worker_instance_type": "t4g.small", 
+               "service_instance_type": "t4g.small", 
+               "num_masters": 3, 
+               "num_workers": 2,
+               "node_ami": ""
+          })
+          k8sargs.update({"lb_address_pub": "",
+               "kubernetes_version": "1.31", 
+               "region": "eu-west-3", 
+               "backup": False, 
+               "backup_name": "test01",
+               "bucket_name": "kap-bucket",
+               "artifact_cache": False,
+               "artifact_checksums": {},
+               "fs_backup": False,
+               "restore_mode": "playbook"
+          })
+
+          save_config()
+
+          print("Arguments reseted successfully!!")
+
+     elif args['mode'] == "list-args":
+          print("Current configuration is:\n")
+
+          print("Environmental configuration:")
+          for key in scriptargs:
+               print(f"{key}: {scriptargs[key]}")
+
+          print("\n")
+
+          print("Terraform configuration:")
+          for key in tfargs:
+               print(f"{key}: {tfargs[key]}")
+
+          print("\n")
+
+          print("Cluster configuration:")
+          for key in k8sargs:
+               print(f"{key}: {k8sargs[key]}")
+
+          print("\n")
+
+     elif args['mode'] == "join-cluster":
+          join_cluster()
+
+     elif args['mode'] == 'save':
+          save_cluster()
+
+     elif args['mode'] == 'restore':
+          restore_cluster()
+
+     elif args['mode'] == 'export':
+          export_backup()
+
+     elif args['mode'] == 'import':
+          import_backup()
+
+     elif args['mode'] == 'fleet':
+          run_fleet(args['fleet_file'], args['fleet_action'], args['fleet_workers'])
+
+     elif args['mode'] == 'bake-image':
+          bake_image()
+
+
+     #Closure of the pooled SSH connections
+     ssh_close_all()
+     print_wait_metrics()
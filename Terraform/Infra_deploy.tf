@@ -36,6 +36,16 @@ variable "num_workers"{
    type = number
 }
 
+variable "node_ami"{
+   type = string
+   default = ""
+}
+
+#Kubernetes nodes boot from the baked image when available, falling back to the base image
+locals {
+   node_ami = var.node_ami != "" ? var.node_ami : "ami-07922e223d3d0ca60"
+}
+
 provider "aws" {
     region = var.region
 }
@@ -182,6 +192,18 @@ resource "aws_security_group_rule" "svc_allow_http_inbound" {
     
 }
 
+resource "aws_security_group_rule" "svc_allow_apt_cache_inbound" {
+
+    type = "ingress"
+    security_group_id = aws_security_group.svc_sec_group_tf.id
+
+    from_port         = 3142
+    to_port           = 3142
+    protocol          = "tcp"
+    cidr_blocks       = [aws_subnet.k8s_private.cidr_block]
+    
+}
+
 resource "aws_security_group_rule" "allow_icmp_inbound" {
     type = "ingress"
     security_group_id = aws_security_group.svc_sec_group_tf.id
@@ -411,7 +433,7 @@ resource "aws_network_interface" "k8s_workers" {
 resource "aws_instance" "kmasters"{
     count = var.num_masters
 
-    ami = "ami-07922e223d3d0ca60"
+    ami = local.node_ami
     instance_type = var.master_instance_type
     key_name = var.key_name
     availability_zone = aws_subnet.k8s_private.availability_zone
@@ -421,6 +443,11 @@ resource "aws_instance" "kmasters"{
       network_interface_id = aws_network_interface.k8s_masters[count.index].id
     }
     
+    #Nodes are not replaced when a newer image is baked, only the new ones use it
+    lifecycle {
+      ignore_changes = [ami]
+    }
+
     tags = {
         Name = "kmaster${count.index}"
     }
@@ -453,7 +480,7 @@ output "kmasters_info" {
 resource "aws_instance" "kworkers"{
     count = var.num_workers
 
-    ami = "ami-07922e223d3d0ca60"
+    ami = local.node_ami
     instance_type = var.worker_instance_type
     key_name = var.key_name
     availability_zone = aws_subnet.k8s_private.availability_zone
@@ -463,6 +490,10 @@ resource "aws_instance" "kworkers"{
       network_interface_id = aws_network_interface.k8s_workers[count.index].id
     }
     
+    lifecycle {
+      ignore_changes = [ami]
+    }
+
     tags = {
         Name = "kworker${count.index}"
     }
@@ -11,15 +11,20 @@ variable "region" {
    type = string
 }
 
+variable "bucket_name" {
+   type = string
+   default = "kap-bucket"
+}
+
 provider "aws" {
     region = var.region
 }
 
 resource "aws_s3_bucket" "k8s_storage"{
-    bucket = "kap-bucket"
+    bucket = var.bucket_name
     force_destroy = true
     tags = {
-        Name = "kap-bucket"
+        Name = var.bucket_name
     }
 
 }